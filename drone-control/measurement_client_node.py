@@ -3,9 +3,14 @@ import socket
 import struct 
 import numpy as np 
 import io 
+import json
+import time
+from queue import Empty
 
 import rospy 
 from std_msgs.msg import String
+import sensor_msgs.msg
+import geometry_msgs.msg
 import mavros_msgs.msg 
 from multiprocessing import Queue
 
@@ -16,6 +21,11 @@ PORT = 8000
 
 COMMAND_QUEUE = Queue() 
 
+#MAVROS state forwarded to the DAQ server for the DSP pipeline 
+COMMAND_TELEMETRY = 8
+TELEMETRY_QUEUE = Queue()
+TELEMETRY_PERIOD = 0.05 #Seconds between telemetry messages, on a connection of their own
+
 
 
 def read_data(connection):
@@ -37,18 +47,43 @@ def write_data(stream, connection, data):
     stream.truncate()
     connection.flush()
 
+def send_telemetry(stream, connection):
+    """Sends everything the MAVROS callbacks queued since the last call, one message per source"""
+    batches = {}
+    while True:
+        try:
+            source, stamp, values = TELEMETRY_QUEUE.get_nowait()
+        except Empty:
+            break
+
+        times, samples = batches.setdefault(source, ([], []))
+        times.append(stamp)
+        samples.append(values)
+
+    for source, (times, samples) in batches.items():
+        write_data(stream, connection, np.array([COMMAND_TELEMETRY], dtype = 'uint8'))
+        write_data(stream, connection, json.dumps({'source': source, 'time': times, 'values': samples, 
+                                                   'sent': time.time()}).encode('utf-8'))
+        read_data(connection)
+
 
 
 def listener():
     rospy.init_node('listener', anonymous = True)
     
     MAVROS_RADIO_SUBSCRIBER = rospy.Subscriber("/mavros/rc/in", mavros_msgs.msg.RCIn, callback)
+    MAVROS_ESC_SUBSCRIBER = rospy.Subscriber("/mavros/esc_status/status", mavros_msgs.msg.ESCStatus, esc_callback)
+    MAVROS_IMU_SUBSCRIBER = rospy.Subscriber("/mavros/imu/data_raw", sensor_msgs.msg.Imu, imu_callback)
+    MAVROS_VELOCITY_SUBSCRIBER = rospy.Subscriber("/mavros/local_position/velocity_local", geometry_msgs.msg.TwistStamped, 
+                                                  velocity_callback)
+    MAVROS_POSE_SUBSCRIBER = rospy.Subscriber("/mavros/local_position/pose", geometry_msgs.msg.PoseStamped, pose_callback)
         
     stream = io.BytesIO()
 
     handshake = np.array([0], dtype = 'uint8')    
     
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as clientSocket:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as clientSocket, \
+         socket.socket(socket.AF_INET, socket.SOCK_STREAM) as telemetrySocket:
         print('Connecting to DAQ on %s:%s'%(PI_ADDRESS, PORT))
 
         #Create connection
@@ -57,6 +92,13 @@ def listener():
         #Create a file in memory to pass data between the two 
         connection = clientSocket.makefile('rwb')
 
+        #Telemetry goes out at a fixed rate whatever the data connection is waiting for, so
+        #the server has it for pipeline subscribers too and as soon as possible after the samples
+        telemetrySocket.connect((PI_ADDRESS, PORT))
+        telemetryConnection = telemetrySocket.makefile('rwb')
+        telemetryStream = io.BytesIO()
+        rospy.Timer(rospy.Duration(TELEMETRY_PERIOD), lambda event: send_telemetry(telemetryStream, telemetryConnection))
+
         ii = 0
         while True:
             write_data(stream, connection, handshake)
@@ -85,4 +127,30 @@ def callback(data):
         else:
             COMMAND_QUEUE.put(0)
 
+def esc_callback(data):
+    #Motor rpm for order tracking, stamped on this wall clock - the server maps it onto the Pi clock
+    stamp = data.header.stamp.to_sec() + time.time() - rospy.get_time()
+    TELEMETRY_QUEUE.put(('rpm', stamp, [float(esc.rpm) for esc in data.esc_status]))
+
+def imu_callback(data):
+    #Frame vibration reference for the adaptive canceller on the server
+    stamp = data.header.stamp.to_sec() + time.time() - rospy.get_time()
+    acceleration = data.linear_acceleration
+    rate = data.angular_velocity
+
+    TELEMETRY_QUEUE.put(('imu', stamp, [acceleration.x, acceleration.y, acceleration.z, rate.x, rate.y, rate.z]))
+
+def velocity_callback(data):
+    #World frame (ENU) velocity and attitude for the hotwire platform motion correction
+    stamp = data.header.stamp.to_sec() + time.time() - rospy.get_time()
+    velocity = data.twist.linear
+
+    TELEMETRY_QUEUE.put(('velocity', stamp, [velocity.x, velocity.y, velocity.z]))
+
+def pose_callback(data):
+    stamp = data.header.stamp.to_sec() + time.time() - rospy.get_time()
+    orientation = data.pose.orientation
+
+    TELEMETRY_QUEUE.put(('attitude', stamp, [orientation.x, orientation.y, orientation.z, orientation.w]))
+
 listener() 
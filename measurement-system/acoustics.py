@@ -0,0 +1,571 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+
+"""
+    Acoustic level stages for the microphone channels. Importing this module
+    registers the stages with dsp_pipeline.
+"""
+
+import numpy as np
+from scipy import signal, optimize
+
+from dsp_pipeline import Stage, register_stage, frame_for
+from dsp_stages import per_channel
+from spectral import CrossSpectralMatrix, AVERAGE_EXPONENTIAL
+
+
+#Reference sound pressure in Pa
+P_REF = 20e-6
+
+#Frequency weighting pole frequencies in Hz (IEC 61672-1)
+WEIGHTING_POLES = {'A': [20.598997, 20.598997, 107.65265, 737.86223, 12194.217, 12194.217],
+                   'C': [20.598997, 20.598997, 12194.217, 12194.217]}
+WEIGHTING_ZEROS = {'A': 4, 'C': 2}
+
+#Frequency grid the high frequency part of the digital weighting is fitted on, from this many Hz up to Nyquist
+WEIGHTING_FIT_LOW = 10.0
+WEIGHTING_FIT_POINTS = 200
+
+#Exponential time weighting constants in seconds
+TIME_CONSTANTS = {'F': 0.125, 'S': 1.0}
+
+#Speed of sound in m/s for the beamforming delays
+SPEED_OF_SOUND = 343.0
+
+#Highest band edge allowed at each rate of the filter bank, as a fraction of that rate
+BAND_EDGE_LIMIT = 0.35
+
+
+def band_centres(fraction, fmin, fmax):
+    """Exact base-2 centre frequencies of the 1/fraction octave bands between fmin and fmax"""
+    first = int(np.ceil(fraction*np.log2(fmin/1000.0)))
+    last = int(np.floor(fraction*np.log2(fmax/1000.0)))
+
+    return 1000.0*2.0**(np.arange(first, last + 1)/fraction)
+
+
+def to_dB(meanSquare, reference):
+    with np.errstate(divide = 'ignore'):
+        return 10*np.log10(meanSquare/reference**2)
+
+
+def analogue_weighting(weighting, frequency):
+    """Magnitude of the analogue A or C weighting at frequency, unnormalised"""
+    s = 2j*np.pi*np.asarray(frequency, dtype = 'float')
+    response = s**WEIGHTING_ZEROS[weighting]
+    for pole in WEIGHTING_POLES[weighting]:
+        response = response/(s + 2*np.pi*pole)
+
+    return np.abs(response)
+
+
+def weighting_sos(weighting, sampleFrequency):
+    """
+    Digital A or C weighting filter normalised to 0 dB at 1 kHz. 'Z' is no
+    weighting.
+
+    The zeros and the low poles go through the bilinear transform. The
+    12.2 kHz pole pair, which the transform would warp 3.4 dB down at
+    4 kHz for fs = 10 kHz, is replaced by real poles and zeros fitted to
+    the rest of the analogue magnitude up to near Nyquist. The response
+    stays within 0.1 dB of IEC 61672 up to 0.9 fs/2 or 20 kHz, whichever
+    is lower, for fs from 5 kHz.
+    """
+    if weighting == 'Z':
+        return None
+
+    if weighting not in WEIGHTING_POLES:
+        raise ValueError('Unknown frequency weighting %s'%weighting)
+
+    #Every pole but the 12.2 kHz pair, so the transform adds no zeros at Nyquist
+    poles = np.array(WEIGHTING_POLES[weighting])
+    numZeros = WEIGHTING_ZEROS[weighting]
+    z, p, k = signal.bilinear_zpk(np.zeros(numZeros), -2*np.pi*poles[:numZeros], 1.0, sampleFrequency)
+    z, p = fit_weighting(weighting, sampleFrequency, z, p, k, len(poles) - numZeros)
+
+    w, h = signal.freqz_zpk(z, p, 1.0, worN = [1000.0], fs = sampleFrequency)
+
+    return signal.zpk2sos(z, p, 1.0/np.abs(h[0]))
+
+
+def fit_weighting(weighting, sampleFrequency, z, p, k, order):
+    """Adds order real poles and zeros fitted to what the digital z, p, k lacks of the analogue magnitude"""
+    frequency = np.geomspace(WEIGHTING_FIT_LOW, 0.98*sampleFrequency/2, WEIGHTING_FIT_POINTS)
+    target = 20*np.log10(analogue_weighting(weighting, frequency)/
+                         np.abs(signal.freqz_zpk(z, p, k, worN = frequency, fs = sampleFrequency)[1]))
+
+    #Poles and zeros kept inside the unit circle, the gain is set afterwards
+    def correction(x):
+        return np.tanh(x[:order]), np.tanh(x[order:])
+
+    def residual(x):
+        fitZeros, fitPoles = correction(x)
+        response = signal.freqz_zpk(fitZeros, fitPoles, 1.0, worN = frequency, fs = sampleFrequency)[1]
+        error = 20*np.log10(np.abs(response)) - target
+
+        return error - error.mean()
+
+    fitZeros, fitPoles = correction(optimize.least_squares(residual, np.r_[np.zeros(order), np.full(order, 0.5)]).x)
+
+    return np.concatenate((z, fitZeros)), np.concatenate((p, fitPoles))
+
+
+class HalfRateDecimator():
+    """Anti-alias filter and keep every other sample, with state carried across blocks"""
+    def __init__(self, numChannels):
+        self.sos = signal.cheby1(8, 0.05, 0.8/2, output = 'sos')
+        self.zi = np.zeros((self.sos.shape[0], numChannels, 2))
+        self.offset = 0
+
+    def process(self, data):
+        filtered, self.zi = signal.sosfilt(self.sos, data, axis = -1, zi = self.zi)
+
+        offset = self.offset
+        self.offset = (offset - data.shape[-1]) % 2
+
+        return filtered[:, offset::2]
+
+
+class OctaveFilterBank():
+    def __init__(self, sampleFrequency, numChannels, fraction = 3, fmin = 25.0, fmax = None, order = 3):
+        """
+        Streaming 1/1 or 1/3 octave filter bank.
+
+        Each band is filtered at the lowest rate of a chain of half-rate
+        decimators that still keeps it below BAND_EDGE_LIMIT of the rate, so
+        the low bands cost almost nothing. All filters keep their state
+        between blocks and work on every channel at once.
+
+        Args:
+            fraction (int): 1 for octave bands, 3 for third octave bands.
+            fmin, fmax (float): Range of band centre frequencies in Hz.
+            order (int): Butterworth order of each band-pass filter.
+        """
+        if fmax is None:
+            fmax = BAND_EDGE_LIMIT*sampleFrequency/2**(0.5/fraction)
+
+        self.fraction = fraction
+        self.numChannels = numChannels
+        self.centres = band_centres(fraction, fmin, fmax)
+
+        if len(self.centres) == 0:
+            raise ValueError('No bands between %g and %g Hz'%(fmin, fmax))
+
+        halfWidth = 2**(0.5/fraction)
+        upperEdges = self.centres*halfWidth
+
+        #Decimation level of each band - the number of halvings it can afford
+        self.levels = np.floor(np.log2(BAND_EDGE_LIMIT*sampleFrequency/upperEdges)).astype(int)
+        if self.levels.min() < 0:
+            raise ValueError('Highest band is too close to the Nyquist frequency')
+
+        self.filters = []
+        for centre, level in zip(self.centres, self.levels):
+            sos = signal.butter(order, [centre/halfWidth, centre*halfWidth], btype = 'bandpass',
+                                fs = sampleFrequency/2**level, output = 'sos')
+            self.filters.append((sos, level))
+
+        self.decimators = [HalfRateDecimator(numChannels) for level in range(self.levels.max())]
+
+        self.reset()
+
+    def reset(self):
+        self.zi = [np.zeros((sos.shape[0], self.numChannels, 2)) for sos, level in self.filters]
+
+        for decimator in self.decimators:
+            decimator.zi[:] = 0
+            decimator.offset = 0
+
+    def process(self, data):
+        """
+        Filters a block of shape (channels, samples).
+
+        Returns:
+            array: Mean square output of each band, shape (channels, bands).
+                Bands with no samples at their rate in this block are NaN.
+        """
+        rates = [np.atleast_2d(data)]
+        for decimator in self.decimators:
+            rates.append(decimator.process(rates[-1]))
+
+        meanSquare = np.full((self.numChannels, len(self.filters)), np.nan)
+
+        for band, (sos, level) in enumerate(self.filters):
+            if rates[level].shape[-1] == 0:
+                continue
+
+            output, self.zi[band] = signal.sosfilt(sos, rates[level], axis = -1, zi = self.zi[band])
+            meanSquare[:, band] = np.mean(output**2, axis = -1)
+
+        return meanSquare
+
+
+@register_stage
+class OctaveBandStage(Stage):
+    """
+    Band Leq of each block for 1/1 or 1/3 octave bands. Levels are in dB
+    re 20 uPa if a microphone sensitivity (V/Pa) is given, else dB re 1 V.
+    """
+    name = 'octave_bands'
+
+    def setup(self, block):
+        numChannels = block.data.shape[0]
+
+        self.bank = OctaveFilterBank(block.sampleFrequency, numChannels,
+                                     fraction = self.params.get('fraction', 3),
+                                     fmin = self.params.get('fmin', 25.0),
+                                     fmax = self.params.get('fmax'))
+
+        if 'sensitivity' in self.params:
+            self.reference = P_REF*per_channel(self.params['sensitivity'], numChannels)
+        else:
+            self.reference = np.ones((numChannels, 1))
+
+    def process(self, block):
+        levels = to_dB(self.bank.process(block.data), self.reference)
+
+        return frame_for(block, centres = self.bank.centres, levels = levels.astype('float32'))
+
+
+class SoundLevelMeter():
+    def __init__(self, sampleFrequency, numChannels, sensitivity = 1.0, weighting = 'A',
+                 timeWeighting = 'F', peakWeighting = 'C'):
+        """
+        Streaming sound level meter for all channels at once.
+
+        Pressure is the voltage divided by the microphone sensitivity (V/Pa).
+        The frequency weighting and peak weighting filters and the Fast/Slow
+        exponential average keep their state between blocks.
+        accumulate() adds a block and read() returns Leq, Lmax and Lpeak
+        since the last read.
+        """
+        self.numChannels = numChannels
+        self.sensitivity = per_channel(sensitivity, numChannels)
+        self.weighting = weighting
+        self.timeWeighting = timeWeighting
+
+        if timeWeighting not in TIME_CONSTANTS:
+            raise ValueError('Unknown time weighting %s'%timeWeighting)
+
+        self.sos = weighting_sos(weighting, sampleFrequency)
+        self.peakSos = weighting_sos(peakWeighting, sampleFrequency)
+
+        #One pole smoother on the squared pressure
+        self.alpha = 1 - np.exp(-1/(TIME_CONSTANTS[timeWeighting]*sampleFrequency))
+
+        self.zi = None if self.sos is None else np.zeros((self.sos.shape[0], numChannels, 2))
+        self.peakZi = None if self.peakSos is None else np.zeros((self.peakSos.shape[0], numChannels, 2))
+        self.smoothed = np.zeros((numChannels, 1))
+
+        self.clear()
+
+    def clear(self):
+        self.energy = np.zeros(self.numChannels)
+        self.samples = 0
+        self.maxSquare = np.zeros(self.numChannels)
+        self.peak = np.zeros(self.numChannels)
+
+    def weight(self, pressure, sos, zi):
+        if sos is None:
+            return pressure, zi
+
+        return signal.sosfilt(sos, pressure, axis = -1, zi = zi)
+
+    def accumulate(self, data):
+        pressure = np.atleast_2d(data)/self.sensitivity
+
+        weighted, self.zi = self.weight(pressure, self.sos, self.zi)
+        peakWeighted, self.peakZi = self.weight(pressure, self.peakSos, self.peakZi)
+
+        square = weighted**2
+        smoothed, _ = signal.lfilter([self.alpha], [1, self.alpha - 1], square, axis = -1,
+                                      zi = (1 - self.alpha)*self.smoothed)
+        self.smoothed = smoothed[:, -1:]
+
+        self.energy += square.sum(axis = -1)
+        self.samples += square.shape[-1]
+        self.maxSquare = np.maximum(self.maxSquare, smoothed.max(axis = -1))
+        self.peak = np.maximum(self.peak, np.abs(peakWeighted).max(axis = -1))
+
+        #Time weighted squared pressure, used by the level distribution
+        return smoothed
+
+    def read(self):
+        """Returns Leq, Lmax and Lpeak in dB re 20 uPa since the last read and starts again"""
+        levels = {'Leq': to_dB(self.energy/max(self.samples, 1), P_REF),
+                  'Lmax': to_dB(self.maxSquare, P_REF),
+                  'Lpeak': to_dB(self.peak**2, P_REF)}
+
+        self.clear()
+
+        return levels
+
+
+@register_stage
+class SoundLevelStage(Stage):
+    """Sound level meter, publishing Leq/Lmax/Lpeak every interval seconds"""
+    name = 'sound_level'
+
+    def setup(self, block):
+        self.meter = SoundLevelMeter(block.sampleFrequency, block.data.shape[0],
+                                     sensitivity = self.params.get('sensitivity', 1.0),
+                                     weighting = self.params.get('weighting', 'A'),
+                                     timeWeighting = self.params.get('timeWeighting', 'F'),
+                                     peakWeighting = self.params.get('peakWeighting', 'C'))
+
+        self.interval = self.params.get('interval', 1.0)
+        self.intervalStart = block.startTime
+
+    def process(self, block):
+        self.meter.accumulate(block.data)
+
+        blockEnd = block.startTime + block.data.shape[-1]/block.sampleFrequency
+        if blockEnd - self.intervalStart < self.interval:
+            return None
+
+        levels = self.meter.read()
+        frame = frame_for(block, intervalStart = np.array(self.intervalStart),
+                          **{key: value.astype('float32') for key, value in levels.items()})
+        self.intervalStart = blockEnd
+
+        return frame
+
+
+class LevelHistogram():
+    def __init__(self, numChannels, lowest = 0.0, highest = 160.0, resolution = 0.1):
+        """
+        Fixed resolution histogram of levels per channel. Memory does not
+        depend on how long it runs, and histograms with the same bins can
+        be merged, e.g. to combine several sessions.
+        """
+        self.numChannels = numChannels
+        self.lowest = float(lowest)
+        self.resolution = float(resolution)
+        self.binNumber = int(np.ceil((highest - lowest)/resolution))
+        self.edges = self.lowest + self.resolution*np.arange(self.binNumber + 1)
+
+        self.counts = np.zeros((numChannels, self.binNumber), dtype = 'int64')
+
+    def add(self, levels):
+        """Adds levels of shape (channels, samples), values outside the range go in the end bins"""
+        bins = np.clip((levels - self.lowest)/self.resolution, 0, self.binNumber - 1).astype(int)
+        bins += self.binNumber*np.arange(self.numChannels)[:, None]
+
+        self.counts += np.bincount(bins.ravel(), minlength = self.counts.size).reshape(self.counts.shape)
+
+    def merge(self, counts):
+        counts = np.asarray(counts, dtype = 'int64')
+        if counts.shape != self.counts.shape:
+            raise ValueError('Histograms have different bins')
+
+        self.counts += counts
+
+    def exceedance(self, percents):
+        """
+        Levels exceeded percents % of the time (L10, L50, L90 ...) by
+        interpolating the cumulative distribution, shape (channels, percents).
+        """
+        cumulative = np.cumsum(self.counts, axis = -1)/np.maximum(self.counts.sum(axis = -1, keepdims = True), 1)
+        targets = 1 - np.asarray(percents, dtype = 'float')/100
+
+        levels = np.empty((self.numChannels, len(targets)))
+        for channel in range(self.numChannels):
+            levels[channel] = np.interp(targets, np.concatenate(([0], cumulative[channel])), self.edges)
+
+        return levels
+
+    def reset(self):
+        self.counts[:] = 0
+
+
+@register_stage
+class LevelDistributionStage(Stage):
+    """
+    Distribution of the time weighted sound level, sampled every
+    sampleInterval seconds. It is queried and reset through control
+    commands instead of being streamed:
+        query - Ln for 'percents' (default 10, 50, 90)
+        histogram - bin edges and counts, for merging sessions on the ground
+        merge - adds 'counts' from a previous session
+    """
+    name = 'level_distribution'
+
+    def setup(self, block):
+        numChannels = block.data.shape[0]
+
+        self.meter = SoundLevelMeter(block.sampleFrequency, numChannels,
+                                     sensitivity = self.params.get('sensitivity', 1.0),
+                                     weighting = self.params.get('weighting', 'A'),
+                                     timeWeighting = self.params.get('timeWeighting', 'F'),
+                                     peakWeighting = 'Z')
+
+        self.histogram = LevelHistogram(numChannels, self.params.get('lowest', 0.0),
+                                        self.params.get('highest', 160.0),
+                                        self.params.get('resolution', 0.1))
+
+        self.step = max(1, int(self.params.get('sampleInterval', 0.1)*block.sampleFrequency))
+        self.offset = 0
+
+    def process(self, block):
+        smoothed = self.meter.accumulate(block.data)
+        self.meter.clear()
+
+        #Sample the time weighted level on a fixed grid that runs across blocks
+        offset = self.offset
+        self.offset = (offset - smoothed.shape[-1]) % self.step
+
+        self.histogram.add(to_dB(smoothed[:, offset::self.step], P_REF))
+
+        return None
+
+    def result(self, percents = (10, 50, 90)):
+        return {'sampleFrequency': np.array(self.configuration[0]),
+                'channels': np.array(self.configuration[1], dtype = 'float'),
+                'percents': np.array(percents, dtype = 'float'),
+                'levels': self.histogram.exceedance(percents),
+                'samples': self.histogram.counts.sum(axis = -1).astype('float')}
+
+    def clear(self):
+        self.histogram.reset()
+
+    def control(self, action, **kwargs):
+        if action == 'query' and self.configuration is not None:
+            return self.result(kwargs.get('percents', [10, 50, 90]))
+
+        if self.configuration is None and action in ('histogram', 'merge'):
+            raise ValueError('Level distribution has no data yet')
+
+        if action == 'histogram':
+            return {'edges': self.histogram.edges, 'counts': self.histogram.counts}
+
+        if action == 'merge':
+            self.histogram.merge(kwargs['counts'])
+            return None
+
+        return super(LevelDistributionStage, self).control(action, **kwargs)
+
+
+def steering_directions(azimuth, elevation):
+    """Unit vectors of an azimuth x elevation grid in degrees, each given as [start, stop, step]"""
+    azimuthAxis = np.arange(azimuth[0], azimuth[1] + 0.5*azimuth[2], azimuth[2])
+    elevationAxis = np.arange(elevation[0], elevation[1] + 0.5*elevation[2], elevation[2])
+
+    az, el = np.meshgrid(np.radians(azimuthAxis), np.radians(elevationAxis))
+    directions = np.stack((np.cos(el)*np.cos(az), np.cos(el)*np.sin(az), np.sin(el)), axis = -1)
+
+    return azimuthAxis, elevationAxis, directions.reshape(-1, 3)
+
+
+class Beamformer():
+    def __init__(self, positions, frequency, bands, directions, distance = None,
+                 speedOfSound = SPEED_OF_SOUND, diagonalRemoval = True):
+        """
+        Frequency domain delay-and-sum beamformer over a grid of directions.
+
+        The steered response power at each frequency bin is a^H C a/M^2,
+        with a the steering vector of each grid point and C the cross
+        spectral matrix, and is summed over the bins of each band. Steering
+        vectors are only computed once, for the bins inside the bands.
+
+        Args:
+            positions (array): (microphones, 3) positions in m.
+            frequency (array): Frequency axis of the cross spectral matrix.
+            bands (list): [low, high] frequency of each band in Hz.
+            directions (array): (points, 3) unit vectors to steer to.
+            distance (float): Focus distance in m for sources in the near
+                field (spherical waves), None for plane waves.
+            diagonalRemoval (bool): Ignore the auto spectra, which removes
+                the self noise of each microphone (wind, vibration) from
+                the map.
+        """
+        positions = np.asarray(positions, dtype = 'float')
+        bands = np.atleast_2d(np.asarray(bands, dtype = 'float'))
+        self.diagonalRemoval = diagonalRemoval
+
+        #Bins used by any band, and which band each of them adds to
+        inBand = (frequency[None, :] >= bands[:, :1]) & (frequency[None, :] <= bands[:, 1:])
+        self.bins = np.flatnonzero(inBand.any(axis = 0))
+        self.bandMatrix = inBand[:, self.bins].astype('float')
+
+        #Propagation delay from each grid point to each microphone, relative delays are all that matter
+        if distance is None:
+            delays = -directions @ positions.T/speedOfSound
+        else:
+            points = distance*directions
+            delays = np.linalg.norm(points[:, None, :] - positions[None, :, :], axis = -1)/speedOfSound
+
+        #(bins, points, microphones)
+        self.steering = np.exp(-2j*np.pi*frequency[self.bins, None, None]*delays[None, :, :])/len(positions)
+
+    def power(self, csd):
+        """Steered response power of each band and grid point from a (M, M, frequencies) CSD estimate"""
+        #estimate[i, j] is conj(X_i)X_j, so E[X X^H] is its transpose
+        matrix = csd[:, :, self.bins]
+        if self.diagonalRemoval:
+            matrix = matrix.copy()
+            np.einsum('iif->if', matrix)[:] = 0
+
+        response = np.einsum('fgi,jif,fgj->fg', self.steering.conj(), matrix, self.steering, optimize = True).real
+
+        return self.bandMatrix @ response
+
+
+@register_stage
+class BeamformStage(Stage):
+    """
+    Steered response power map of a microphone array for some frequency
+    bands, updated from a streaming cross spectral matrix. 'positions' are
+    the (x, y, z) positions of the channels in m, 'bands' a list of
+    [low, high] in Hz and 'azimuth'/'elevation' the grid as [start, stop,
+    step] in degrees. With 'distance' the beams focus at that range
+    instead of assuming plane waves. The map is the band power in dB re
+    20 uPa if a microphone sensitivity (V/Pa) is given, else dB re 1 V,
+    with the direction of the peak of each band.
+    """
+    name = 'beamform'
+
+    def setup(self, block):
+        numChannels = block.data.shape[0]
+        positions = np.asarray(self.params['positions'], dtype = 'float')
+        if positions.shape != (numChannels, 3):
+            raise ValueError('Beamforming needs a position for each of the %d channels'%numChannels)
+
+        self.matrix = CrossSpectralMatrix(block.sampleFrequency, numChannels,
+                                          nperseg = self.params.get('nperseg', 512),
+                                          noverlap = self.params.get('noverlap'),
+                                          window = self.params.get('window', 'hann'),
+                                          average = self.params.get('average', AVERAGE_EXPONENTIAL),
+                                          averages = self.params.get('averages', 16))
+
+        self.azimuth, self.elevation, directions = steering_directions(self.params.get('azimuth', [-180, 180, 10]),
+                                                                       self.params.get('elevation', [-90, 90, 10]))
+        self.bands = np.atleast_2d(np.asarray(self.params['bands'], dtype = 'float'))
+
+        #Pressure products of each microphone pair
+        sensitivity = per_channel(self.params.get('sensitivity', 1.0), numChannels)
+        self.calibration = (sensitivity*sensitivity.T)[:, :, None]
+        self.reference = P_REF if 'sensitivity' in self.params else 1.0
+
+        self.beamformer = Beamformer(positions, self.matrix.frequency, self.bands, directions,
+                                     self.params.get('distance'), self.params.get('speedOfSound', SPEED_OF_SOUND),
+                                     self.params.get('diagonalRemoval', True))
+
+    def process(self, block):
+        if not self.matrix.update(block.data):
+            return None
+
+        #Density summed over the bins of each band, times the bin width for the band power
+        frequency = self.matrix.frequency
+        power = self.beamformer.power(self.matrix.estimate/self.calibration)*(frequency[1] - frequency[0])
+        peaks = np.argmax(power, axis = -1)
+
+        #Negative powers are possible with the diagonal removed
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            level = 10*np.log10(np.maximum(power, 0)/self.reference**2)
+
+        shape = (len(self.bands), len(self.elevation), len(self.azimuth))
+        return frame_for(block, bands = self.bands, azimuth = self.azimuth, elevation = self.elevation,
+                         map = level.reshape(shape).astype('float32'),
+                         peakAzimuth = self.azimuth[peaks % len(self.azimuth)],
+                         peakElevation = self.elevation[peaks//len(self.azimuth)],
+                         segments = np.array(self.matrix.segments, dtype = 'float'))
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+
+"""
+    Runs the MCC 128 scan in its own minimal process.
+
+    The acquisition process does nothing but move samples from the HAT into a
+    SharedRing, so client threads and DSP in the server process can no longer
+    hold the GIL while a_in_scan_read is due. It can be pinned to its own core
+    and given real-time scheduling priority. RingDAQHandler is a drop in
+    replacement for DAQHandler in the servers that reads from the ring instead
+    of the HAT.
+
+    In triggered mode the process runs finite scans started by the HAT's
+    external trigger input and re-arms after each one. The wait for the
+    trigger is a timed a_in_scan_read, so nothing spins on a_in_scan_status.
+"""
+
+import os
+import queue
+import threading
+from multiprocessing import Queue, Process
+from time import time
+
+import numpy as np
+
+from daqhats import mcc128, OptionFlags, HatIDs, HatError, TriggerModes, AnalogInputMode, AnalogInputRange
+from daqhats_utils import select_hat_device, chan_list_to_mask
+
+from shared_ring import SharedRing, RingOverrunError, RING_NAME
+
+
+#Acquisition process settings
+ACQUISITION_CPU = 3        #Core reserved for the acquisition process (Pi has 0-3)
+ACQUISITION_PRIORITY = 50  #SCHED_FIFO priority, 1-99
+READ_INTERVAL = 0.02       #Seconds of data requested per a_in_scan_read call
+HAT_BUFFER_SECONDS = 2.0   #Size of the library's internal scan buffer
+TRIGGER_WAIT = 0.5         #Seconds a read waits for the trigger before checking for commands
+
+#Commands sent to the acquisition process
+COMMAND_CONFIGURE = 'configure'
+COMMAND_STOP = 'stop'
+COMMAND_TRIGGER = 'trigger'
+
+
+def set_realtime(cpu, priority):
+    """Pins the calling process to a core and raises its scheduling priority"""
+    try:
+        os.sched_setaffinity(0, {cpu})
+        print('[DAQ] Acquisition pinned to CPU', cpu)
+    except (AttributeError, OSError) as err:
+        print('[DAQ] Could not set CPU affinity:', err)
+
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        print('[DAQ] Acquisition running with SCHED_FIFO priority', priority)
+    except (AttributeError, OSError) as err:
+        #Fall back to the best nice value we are allowed
+        print('[DAQ] Could not set real-time priority:', err)
+        try:
+            os.nice(-10)
+        except OSError:
+            pass
+
+
+class AcquisitionProcess(Process):
+    def __init__(self, channels, sampleFrequency, inputMode = AnalogInputMode.SE,
+                 inputRange = AnalogInputRange.BIP_5V, ringName = RING_NAME,
+                 cpu = ACQUISITION_CPU, priority = ACQUISITION_PRIORITY, triggerMode = None, captureLength = 0):
+        super(AcquisitionProcess, self).__init__(daemon = True)
+
+        self.channels = list(channels)
+        self.sampleFrequency = sampleFrequency
+        self.inputMode = inputMode
+        self.inputRange = inputRange
+        self.ringName = ringName
+        self.cpu = cpu
+        self.priority = priority
+
+        #Name of a TriggerModes member, None for a continuous scan
+        self.triggerMode = triggerMode
+        self.captureLength = int(captureLength)
+
+        self.commandQueue = Queue()
+
+    #Parent side - ask the child to change the scan or stop
+    def configure(self, channels, sampleFrequency):
+        self.commandQueue.put((COMMAND_CONFIGURE, list(channels), sampleFrequency))
+
+    def set_trigger(self, triggerMode, captureLength):
+        self.commandQueue.put((COMMAND_TRIGGER, triggerMode, int(captureLength)))
+
+    def stop(self):
+        self.commandQueue.put((COMMAND_STOP,))
+        self.join(timeout = 5.0)
+
+    #Child side
+    def run(self):
+        set_realtime(self.cpu, self.priority)
+
+        self.ring = SharedRing(self.ringName)
+
+        self.address = select_hat_device(HatIDs.MCC_128)
+        self.hat = mcc128(self.address)
+        self.hat.a_in_mode_write(self.inputMode)
+        self.hat.a_in_range_write(self.inputRange)
+
+        self.start_scan()
+
+        try:
+            while True:
+                #Handle commands without blocking the scan
+                try:
+                    command = self.commandQueue.get_nowait()
+                except queue.Empty:
+                    command = None
+
+                if command is not None:
+                    if command[0] == COMMAND_STOP:
+                        break
+
+                    self.apply(command)
+
+                if self.triggerMode is not None:
+                    self.read_triggered()
+                    continue
+
+                readResult = self.hat.a_in_scan_read(self.readSize, self.readTimeout)
+
+                if readResult.hardware_overrun or readResult.buffer_overrun:
+                    print('\n\n[DAQ] Overrun, restarting scan\n')
+                    self.ring.count_overrun()
+                    self.stop_scan()
+                    self.start_scan()
+                    continue
+
+                if len(readResult.data) > 0:
+                    self.ring.write(readResult.data)
+
+        finally:
+            self.stop_scan()
+            self.ring.close()
+
+    def apply(self, command):
+        """Restarts the scan with new settings, going back to the previous ones if the HAT refuses them"""
+        previous = (self.channels, self.sampleFrequency, self.triggerMode, self.captureLength)
+        self.stop_scan()
+
+        try:
+            if command[0] == COMMAND_CONFIGURE:
+                self.channels, self.sampleFrequency = command[1], command[2]
+
+            elif command[0] == COMMAND_TRIGGER:
+                self.triggerMode, self.captureLength = command[1], command[2]
+
+            self.start_scan()
+
+        except (HatError, ValueError) as err:
+            print('[DAQ] Could not apply %s, restoring the previous scan:'%command[0], err)
+            self.stop_scan()
+            self.channels, self.sampleFrequency, self.triggerMode, self.captureLength = previous
+            self.start_scan()
+
+    def start_scan(self):
+        numChannels = len(self.channels)
+        actualScanRate = self.hat.a_in_scan_actual_rate(numChannels, self.sampleFrequency)
+
+        print('\n [DAQ] Acquisition process using MCC 128 HAT device at address', self.address)
+        print('    Requested scan rate: ', self.sampleFrequency)
+        print('    Actual scan rate: ', actualScanRate)
+        print('    Channels: ', end='')
+        print(', '.join([str(chan) for chan in self.channels]))
+
+        self.readSize = max(1, int(actualScanRate*READ_INTERVAL))
+        self.readTimeout = 10*READ_INTERVAL
+        self.actualScanRate = actualScanRate
+
+        if self.triggerMode is not None:
+            print('[DAQ] Armed for %s trigger, %d samples per capture'%(self.triggerMode, self.captureLength))
+            self.arm_trigger()
+            return
+
+        #Publish the new configuration before any data from it is written - the HAT returns
+        #the channels of the mask in ascending order whatever order they were listed in
+        self.ring.configure(sorted(self.channels), actualScanRate, startTime = time())
+
+        self.hat.a_in_scan_start(chan_list_to_mask(self.channels),
+                                 int(actualScanRate*HAT_BUFFER_SECONDS),
+                                 self.sampleFrequency, OptionFlags.CONTINUOUS)
+
+    def arm_trigger(self):
+        #The ring is configured when the trigger arrives, each capture is a new generation
+        self.captured = None
+        self.hat.trigger_mode(TriggerModes[self.triggerMode])
+        self.hat.a_in_scan_start(chan_list_to_mask(self.channels), self.captureLength,
+                                 self.sampleFrequency, OptionFlags.EXTTRIGGER)
+
+    def read_triggered(self):
+        """Waits a while for the trigger or reads the running capture, re-arming once it is complete"""
+        readResult = self.hat.a_in_scan_read(self.readSize, TRIGGER_WAIT)
+
+        if readResult.hardware_overrun or readResult.buffer_overrun:
+            print('\n\n[DAQ] Overrun, re-arming trigger\n')
+            self.ring.count_overrun()
+            self.stop_scan()
+            self.start_scan()
+            return
+
+        frameNumber = len(readResult.data)//len(self.channels)
+        if frameNumber == 0:
+            return
+
+        if self.captured is None:
+            #The scan starts at the trigger, so it arrived as many samples ago as have been read
+            triggerTime = time() - frameNumber/self.actualScanRate
+            self.ring.configure(sorted(self.channels), self.actualScanRate, startTime = triggerTime,
+                                captureLength = self.captureLength)
+            self.captured = 0
+
+        self.ring.write(readResult.data)
+        self.captured += frameNumber
+
+        if self.captured >= self.captureLength:
+            self.stop_scan()
+            self.arm_trigger()
+
+    def stop_scan(self):
+        self.hat.a_in_scan_stop()
+        self.hat.a_in_scan_cleanup()
+
+
+#Same interface as DAQHandler, but reads blocks out of the shared ring
+class RingDAQHandler():
+    def __init__(self, process, sampleNumber, ringName = RING_NAME, outputFile = None):
+        self.process = process
+        self.sampleNumber = int(sampleNumber)
+        self.outputFile = outputFile
+
+        self.ring = SharedRing(ringName, readOnly = True)
+
+        #Samples per triggered capture, 0 while the scan is continuous
+        self.captureLength = process.captureLength if process.triggerMode is not None else 0
+
+        #Every client thread gets its own read position so clients no longer split the stream
+        self.cursors = threading.local()
+
+    @property
+    def channels(self):
+        return self.ring.channels
+
+    @property
+    def sampleFrequency(self):
+        return self.ring.sample_frequency
+
+    @property
+    def numChannels(self):
+        return self.ring.num_channels
+
+    def wait_for_generation(self, generation, timeout = 5.0):
+        deadline = time() + timeout
+        while self.ring.generation <= generation and time() < deadline:
+            self.ring.wait_for(self.ring.write_count + 1, timeout = 0.1)
+
+    def next_block(self, sampleNumber = None):
+        """
+        Waits for the next contiguous block for the calling thread without
+        copying it, so the range can be handed to another process.
+
+        Returns:
+            int: Absolute index of the first frame of the block.
+        """
+        if sampleNumber is None:
+            sampleNumber = self.sampleNumber
+
+        cursors = self.cursors
+
+        #Start from the newest data on the first read or after a reconfiguration
+        if getattr(cursors, 'generation', None) != self.ring.generation:
+            cursors.generation = self.ring.generation
+            cursors.position = max(self.ring.write_count, self.ring.generation_start)
+
+        #This client fell too far behind - skip to the newest data
+        if self.ring.write_count - cursors.position > self.ring.capacity - sampleNumber:
+            print('\n\nRing overrun\n')
+            cursors.position = self.ring.write_count
+
+        start = cursors.position
+        timeout = 2*sampleNumber/max(self.sampleFrequency, 1.0) + 1.0
+
+        if not self.ring.wait_for(start + sampleNumber, timeout = timeout):
+            raise TimeoutError('[DAQ] No data from the acquisition process')
+
+        cursors.position = start + sampleNumber
+
+        return start
+
+    def read_block(self, sampleNumber = None):
+        """
+        Returns the next contiguous block for the calling thread.
+
+        Returns:
+            (int, array): Absolute index of the first frame and the data
+            with shape (channels, sampleNumber).
+        """
+        if sampleNumber is None:
+            sampleNumber = self.sampleNumber
+
+        while True:
+            start = self.next_block(sampleNumber)
+
+            try:
+                return start, self.ring.read(start, sampleNumber)
+            except RingOverrunError:
+                self.cursors.position = self.ring.write_count
+
+    def read_capture(self, timeout = TRIGGER_WAIT):
+        """
+        Waits for the next complete triggered capture for the calling thread.
+
+        Returns:
+            (int, int, float, array): Generation of the capture, absolute
+            index of its first frame, trigger time and the data. None if no
+            capture completed within timeout.
+        """
+        cursors = self.cursors
+        if not hasattr(cursors, 'capture'):
+            cursors.capture = self.ring.generation
+
+        deadline = time() + timeout
+        while self.ring.generation == cursors.capture:
+            if time() > deadline:
+                return None
+
+            #Triggers are rare, a coarse poll of the shared header costs nothing
+            self.ring.wait_for(self.ring.write_count + 1, timeout = deadline - time(), pollInterval = 0.01)
+
+        #Read the capture settings again if the writer started another generation meanwhile
+        generation = None
+        while generation != self.ring.generation:
+            generation = self.ring.generation
+            start, startTime, length = self.ring.generation_start, self.ring.start_time, self.ring.capture_length
+
+        cursors.capture = generation
+
+        if length == 0 or not self.ring.wait_for(start + length, timeout = 2*length/self.sampleFrequency + 1.0):
+            return None
+
+        try:
+            return generation, start, startTime, self.ring.read(start, length)
+        except RingOverrunError:
+            return None
+
+    def read_data(self):
+        start, dataArray = self.read_block()
+
+        #Time relative to the start of the current scan configuration
+        t0 = (start - self.ring.generation_start)/self.sampleFrequency
+        timeArray = t0 + np.arange(self.sampleNumber)/self.sampleFrequency
+
+        return timeArray, dataArray
+
+    def change_channel_settings(self, channelList):
+        generation = self.ring.generation
+        self.process.configure([int(channel) for channel in channelList], self.sampleFrequency)
+        self.wait_for_generation(generation)
+
+    def change_trigger_settings(self, triggerMode, captureLength):
+        """Switches to captures of captureLength samples on each triggerMode edge, or back to continuous with None"""
+        if triggerMode is not None:
+            if triggerMode not in TriggerModes.__members__:
+                raise ValueError('Unknown trigger mode %s'%triggerMode)
+
+            #Each capture has to fit in the ring at once
+            if not 0 < captureLength <= self.ring.capacity:
+                raise ValueError('Capture length must be between 1 and %d samples'%self.ring.capacity)
+
+        self.process.set_trigger(triggerMode, captureLength)
+        self.captureLength = int(captureLength) if triggerMode is not None else 0
+
+    def change_sample_settings(self, sampleFrequency, sampleNumber):
+        generation = self.ring.generation
+        self.sampleNumber = int(sampleNumber)
+        self.process.configure(self.channels, sampleFrequency)
+        self.wait_for_generation(generation)
+
+    def record_data(self):
+        print('[DAQ] Recording ')
+
+        timeArray, dataArray = self.read_data()
+
+        with open(self.outputFile, 'w') as f:
+            f.write('Time (s),' + ','.join(['ch.%d (V)'%chan for chan in self.channels]) + '\n')
+            np.savetxt(f, np.vstack((timeArray, dataArray)).T, fmt='%6e', delimiter=',')
+
+        print('[DAQ] Finished Recording')
+
+    def stop_hat(self):
+        self.process.stop()
@@ -28,6 +28,20 @@ from socketserver import ThreadingTCPServer, StreamRequestHandler
 import io 
 import struct 
 
+#Imports for the separate acquisition process and DSP workers
+from shared_ring import SharedRing, RingOverrunError
+from acquisition_process import AcquisitionProcess, RingDAQHandler
+
+#Imports for the streaming DSP pipeline - importing the stage modules registers the stages
+from dsp_pipeline import SharedPipeline, PipelineRunner, PipelineCommandMixin
+import dsp_stages
+import spectral
+import acoustics
+import hotwire
+import rotor
+import events
+from dsp_pool import DSPPool, welch_task
+
 #DAQ Settings
 SAMPLE_FREQUENCY = 10000.0 #Hz
 SAMPLE_NUMBER = 10000
@@ -48,13 +62,27 @@ OUTPUT_FILE = DATA_DIR / 'sound_levels_test.txt'
 #Server settings
 PORT = 8000
 
+#Run the HAT reader in its own process and read from the shared ring
+USE_ACQUISITION_PROCESS = True
+
+#Hardware trigger - name of a TriggerModes member for repeated captures on the trigger input, None for continuous
+TRIGGER_MODE = None
+CAPTURE_LENGTH = SAMPLE_NUMBER #Samples per triggered capture
+
 
 #Class to handle DAQ i/o - call read_data to return an array of data
 class DAQHandler():
-    def __init__(self):
+    def __init__(self, pool = None):
         #Inherit process function 
         super(DAQHandler, self).__init__()
 
+        #Optional DSPPool used to run the spectra outside this thread
+        self.pool = pool
+
+        #Stream description used by the pipeline runner
+        self.channels = CHANNELS
+        self.sampleFrequency = SAMPLE_FREQUENCY
+
         #Setup the DAQ
         self.setup_daq()
 
@@ -136,6 +164,12 @@ class DAQHandler():
     def read_spectrum(self, binNumber):
         #Hardcoded read parameter 
         timeArray, dataArray = self.read_data()
+
+        #Hand the block to a worker process if there is a pool
+        if self.pool is not None:
+            return self.pool.submit_array(welch_task, dataArray, fs = SAMPLE_FREQUENCY,
+                                          nperseg = NPERSEG).result()
+
         #Create zero array with data
         welchOutput, welchFrequency = signal.welch(dataArray, fs = SAMPLE_FREQUENCY, nperseg = NPERSEG)
 
@@ -187,16 +221,39 @@ class DAQHandler():
 
 
 
+#Ring reader that hands spectrum requests to the DSP pool by ring position
+class RingSpectrumDAQHandler(RingDAQHandler):
+    def __init__(self, process, sampleNumber, pool, **kwargs):
+        super(RingSpectrumDAQHandler, self).__init__(process, sampleNumber, **kwargs)
+
+        self.pool = pool
+
+    def submit_spectrum(self):
+        start = self.next_block()
+
+        return self.pool.submit_ring(welch_task, start, self.sampleNumber,
+                                     fs = self.sampleFrequency, nperseg = NPERSEG)
+
+    def read_spectrum(self, binNumber):
+        #The handler thread only waits here, the transform runs in a worker process
+        return self.submit_spectrum().result()
+
+
+
 #Handles TCP server requests - once connected the server reads from the daq, waits for a handshake/command, and 
-class DAQRequestHandler(StreamRequestHandler):
-    def __init__(self, daq):
+class DAQRequestHandler(PipelineCommandMixin, StreamRequestHandler):
+    def __init__(self, daq, pipeline):
         # super(DAQRequestHandler, self).__init__()
         self.daq = daq
+        self.pipeline = pipeline
+
+        #Pipeline subscriptions of this client, dropped when it disconnects
+        self.subscriptionIDs = set()
 
 
     #Override to call function - calls init class and inputs the read queue 
     def __call__(self, request, client_address, server):
-        h = DAQRequestHandler(self.daq)
+        h = DAQRequestHandler(self.daq, self.pipeline)
         StreamRequestHandler.__init__(h, request, client_address, server)
 
 
@@ -207,9 +264,14 @@ class DAQRequestHandler(StreamRequestHandler):
         stream = io.BytesIO()
 
       
-        while True: 
-            #Read handshake/command
-            self.read_command()
+        #Read handshake/command until the client disconnects
+        try:
+            while self.read_command():
+                pass
+        except ConnectionError:
+            pass
+
+        print(f"[DAQ Server] Client disconnected: {self.client_address[0]}:{self.client_address[1]}")
 
     def send_data(self, stream, data):
         #Create numpy array from DAQ data
@@ -226,7 +288,12 @@ class DAQRequestHandler(StreamRequestHandler):
         self.wfile.flush()
 
     def read_command(self):
-        data_len = struct.unpack('<L', self.rfile.read(struct.calcsize('<L')))[0]
+        """Handles one command, returns False once the client has closed the connection"""
+        header = self.rfile.read(struct.calcsize('<L'))
+        if len(header) < struct.calcsize('<L'):
+            return False
+
+        data_len = struct.unpack('<L', header)[0]
         response = np.frombuffer(self.rfile.read(data_len), dtype = 'uint8')
 
         #Save data if the array reads 1
@@ -238,10 +305,21 @@ class DAQRequestHandler(StreamRequestHandler):
 
         elif response[0]==2:
             self.on_spectrum_command()
+
+        #Subscribe/fetch/unsubscribe/control commands for the DSP pipeline
+        else:
+            self.read_pipeline_command(int(response[0]))
+
+        return True
     
 
     def on_stream_command(self):
-        timeArray, dataArray = self.daq.read_data() 
+        #No block between triggered captures - reply with the same placeholder as after an overrun
+        try:
+            timeArray, dataArray = self.daq.read_data() 
+        except TimeoutError as err:
+            print('[DAQ Server] No data to stream:', err)
+            timeArray, dataArray = np.array([1]), np.array([1])
 
         stream = io.BytesIO()
 
@@ -255,7 +333,12 @@ class DAQRequestHandler(StreamRequestHandler):
         self.daq.record_data()
 
     def on_spectrum_command(self):
-        welchFrequency, welchOutput = self.daq.read_spectrum(FFT_BIN_NUMBER)
+        try:
+            welchFrequency, welchOutput = self.daq.read_spectrum(FFT_BIN_NUMBER)
+        #The worker can find the block overwritten or, without the ring, have nothing to read
+        except (TimeoutError, RingOverrunError, AttributeError) as err:
+            print('[DAQ Server] No data for the spectrum:', repr(err))
+            welchFrequency, welchOutput = np.array([1]), np.array([1])
 
         stream = io.BytesIO()
 
@@ -266,7 +349,23 @@ class DAQRequestHandler(StreamRequestHandler):
 
 def main():
     #Initialize data acquisition device 
-    daq = DAQHandler()
+    if USE_ACQUISITION_PROCESS:
+        #The ring is owned by the server process, the acquisition process only writes to it
+        ring = SharedRing(create = True)
+
+        acquisition = AcquisitionProcess(CHANNELS, SAMPLE_FREQUENCY, AnalogInputMode.DIFF,
+                                         AnalogInputRange.BIP_1V,
+                                         triggerMode = TRIGGER_MODE, captureLength = CAPTURE_LENGTH)
+        acquisition.start()
+
+        #Workers attach to the ring, so the pool is started after it exists
+        pool = DSPPool()
+
+        daq = RingSpectrumDAQHandler(acquisition, SAMPLE_NUMBER, pool, outputFile = OUTPUT_FILE)
+        daq.wait_for_generation(0)
+    else:
+        pool = DSPPool(ringName = None)
+        daq = DAQHandler(pool)
 
     #Local host
     HOST = '0.0.0.0'
@@ -274,7 +373,11 @@ def main():
     #Create server
     print('Creating server %s:%s'%(HOST, PORT))
 
-    server = ThreadingTCPServer((HOST, PORT), DAQRequestHandler(daq), False)
+    #Shared DSP pipeline, fed in its own thread while there are subscribers
+    pipeline = SharedPipeline()
+    PipelineRunner(daq, pipeline).start()
+
+    server = ThreadingTCPServer((HOST, PORT), DAQRequestHandler(daq, pipeline), False)
     
     #Fix for when server shuts down inproperly - enables rebinding to the same address
     server.allow_reuse_address = True 
@@ -282,7 +385,12 @@ def main():
     server.server_activate() 
 
     #Start server 
-    server.serve_forever()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt: daq.stop_hat()
+    finally:
+        pool.shutdown()
+        if USE_ACQUISITION_PROCESS: ring.close()
 
 
 # @dataclass 
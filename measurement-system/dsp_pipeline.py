@@ -0,0 +1,603 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+
+"""
+    Streaming DSP pipeline shared between all clients of a server.
+
+    A client subscribes with a list of stages, e.g.
+
+        [{"stage": "filter", "kind": "highpass", "cutoff": 5.0},
+         {"stage": "psd", "nperseg": 256}]
+
+    Subscriptions are merged into a tree keyed by the stage settings, so
+    identical prefixes are only computed once per block no matter how many
+    clients asked for them. Each stage gets either a Block of samples or the
+    frame (dict of arrays) produced by the stage before it.
+"""
+
+import dataclasses
+import io
+import itertools
+import json
+import struct
+import threading
+from collections import deque
+from time import sleep, time
+
+import numpy as np
+
+from telemetry import TELEMETRY
+
+
+#Command numbers shared by the servers
+COMMAND_SUBSCRIBE = 4
+COMMAND_FETCH = 5
+COMMAND_UNSUBSCRIBE = 6
+COMMAND_CONTROL = 7
+COMMAND_TELEMETRY = 8
+COMMAND_TRIGGER = 9
+
+#Number of outputs kept for a subscriber that is not fetching
+SUBSCRIPTION_QUEUE = 32
+
+#Seconds the runner waits before reading again after a DAQ error
+READ_RETRY = 1.0
+
+
+#Registry of stage classes by name - filled in by register_stage
+STAGES = {}
+
+
+def register_stage(cls):
+    STAGES[cls.name] = cls
+    return cls
+
+
+@dataclasses.dataclass
+class Block():
+    """Samples from every acquired channel for one read of the DAQ"""
+    data: np.ndarray                #(channels, samples)
+    sampleFrequency: float
+    channels: list
+    start: int = 0                  #Absolute index of the first sample
+    startTime: float = 0.0          #Wall clock time of the first sample
+    channelOffsets: np.ndarray = None #Time each channel is sampled after the start of its scan, s
+
+    def to_frame(self):
+        return frame_for(self, data = self.data)
+
+    def replace(self, **changes):
+        return dataclasses.replace(self, **changes)
+
+
+def scan_offsets(channels, sampleFrequency):
+    """
+    The MCC 128 converts the channels of a scan one after the other in
+    ascending channel order, so each channel lags the first one of the
+    scan by its position over the aggregate rate.
+    """
+    position = np.argsort(np.argsort(channels))
+
+    return position/(sampleFrequency*len(channels))
+
+
+def channel_rows(channels, selected):
+    """Rows of the block data holding the MCC channel numbers in selected"""
+    channels = list(channels)
+
+    return np.array([channels.index(channel) for channel in selected], dtype = int)
+
+
+def describe(item):
+    """Returns the properties a stage has to be set up again for if they change"""
+    if isinstance(item, Block):
+        return (item.sampleFrequency, tuple(item.channels))
+
+    return (float(item['sampleFrequency']), tuple(np.atleast_1d(item['channels'])))
+
+
+def frame_for(item, **arrays):
+    """Creates an output frame carrying the stream metadata of the input"""
+    if isinstance(item, Block):
+        frame = {'sampleFrequency': np.array(item.sampleFrequency),
+                 'channels': np.array(item.channels, dtype = 'float'),
+                 'start': np.array(item.start, dtype = 'float'),
+                 'startTime': np.array(item.startTime)}
+
+        if item.channelOffsets is not None:
+            frame['channelOffsets'] = np.asarray(item.channelOffsets, dtype = 'float')
+    else:
+        frame = {key: item[key] for key in ('sampleFrequency', 'channels', 'start', 'startTime', 'channelOffsets')
+                 if key in item}
+
+    frame.update(arrays)
+
+    return frame
+
+
+class Stage():
+    """
+    Base class for pipeline stages. Subclasses set name, implement
+    process() and, if they keep state, setup() and reset(). Stages that
+    accumulate results implement result() for the query command and
+    clear() for reset. Keyword arguments given in the subscription are
+    stored on self.params.
+    """
+    name = None
+
+    def __init__(self, **params):
+        self.params = params
+        self.configuration = None
+
+    def __call__(self, item):
+        #(Re)initialise state whenever the stream changes
+        configuration = describe(item)
+        if configuration != self.configuration:
+            self.setup(item)
+            self.configuration = configuration
+
+        return self.process(item)
+
+    def setup(self, item):
+        pass
+
+    def process(self, item):
+        raise NotImplementedError
+
+    def reset(self):
+        self.configuration = None
+
+    def snapshot(self):
+        """Output for a subscriber joining an existing stage, None if there is nothing to catch up on"""
+        return None
+
+    def result(self):
+        """Frame answering the query command, only called once the stage has seen data"""
+        raise ValueError('Stage %s does not support query'%self.name)
+
+    def clear(self):
+        """Restarts what the stage accumulated, only called once the stage has seen data"""
+        self.reset()
+
+    def control(self, action, **kwargs):
+        """Handles run time commands from the clients, returns an optional frame"""
+        #Nothing to query or clear before the first block, the settings can still be changed
+        if action == 'query':
+            return None if self.configuration is None else self.result()
+
+        if action == 'reset':
+            if self.configuration is not None:
+                self.clear()
+            return None
+
+        if action == 'configure':
+            self.params.update(kwargs)
+            self.reset()
+            return None
+
+        raise ValueError('Stage %s does not support %s'%(self.name, action))
+
+
+def stage_key(spec):
+    """Identifies a stage by its name and settings, used to share identical stages"""
+    return json.dumps(spec, sort_keys = True)
+
+
+def create_stage(spec):
+    spec = dict(spec)
+    name = spec.pop('stage')
+
+    if name not in STAGES:
+        raise ValueError('Unknown stage %s'%name)
+
+    return STAGES[name](**spec)
+
+
+class PipelineNode():
+    def __init__(self, stage = None, key = None, parent = None):
+        self.stage = stage
+        self.key = key
+        self.parent = parent
+        self.children = {}
+        self.subscriptions = []
+        self.references = 0
+
+
+class Subscription():
+    def __init__(self, subscriptionID, spec, nodes):
+        self.id = subscriptionID
+        self.spec = spec
+        self.nodes = nodes
+        self.outputs = deque(maxlen = SUBSCRIPTION_QUEUE)
+
+
+class SharedPipeline():
+    def __init__(self):
+        self.root = PipelineNode()
+        self.subscriptions = {}
+        self.ids = itertools.count(1)
+
+        #Last block processed, new subscriptions are checked against it
+        self.lastBlock = None
+
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+
+    def attach(self, spec):
+        """Finds or creates the nodes for a chain of stages, call with the lock held"""
+        node = self.root
+        nodes = []
+
+        for stageSpec in spec:
+            key = stage_key(stageSpec)
+
+            if key not in node.children:
+                node.children[key] = PipelineNode(create_stage(stageSpec), key, node)
+
+            node = node.children[key]
+            nodes.append(node)
+
+        for node in nodes:
+            node.references += 1
+
+        return nodes
+
+    def detach(self, nodes):
+        """Releases a chain of nodes and drops the stages nobody uses any more"""
+        for node in reversed(nodes):
+            node.references -= 1
+            if node.references == 0:
+                del node.parent.children[node.key]
+
+    def validate(self, spec):
+        """
+        Sets up new copies of the stages in spec on the last block, so a
+        chain that cannot run on the stream (a tacho channel that is not
+        acquired...) is refused with a ValueError instead of failing on every
+        block. The last stage is only set up, so nothing is output or saved.
+        """
+        stages = [create_stage(stageSpec) for stageSpec in spec]
+        item = self.lastBlock
+
+        for number, stage in enumerate(stages):
+            if item is None:
+                break
+
+            try:
+                stage.setup(item)
+                stage.configuration = describe(item)
+
+                if number < len(stages) - 1:
+                    item = stage.process(item)
+            except Exception as err:
+                raise ValueError('Stage %s cannot run on the stream: %r'%(stage.name, err)) from err
+
+    def subscribe(self, spec):
+        """Adds the chain of stages in spec to the tree and returns a subscription id"""
+        if not spec:
+            raise ValueError('A subscription needs at least one stage')
+
+        self.validate(spec)
+
+        with self.lock:
+            nodes = self.attach(spec)
+
+            subscription = Subscription(next(self.ids), list(spec), nodes)
+            nodes[-1].subscriptions.append(subscription)
+
+            #Stages with history hand it to a subscriber joining them
+            snapshot = nodes[-1].stage.snapshot()
+            if snapshot is not None:
+                subscription.outputs.append(snapshot)
+            self.subscriptions[subscription.id] = subscription
+
+            self.active.set()
+
+            return subscription.id
+
+    def remove(self, subscription):
+        """Drops a subscription and the stages only it used, call with the lock held"""
+        del self.subscriptions[subscription.id]
+
+        subscription.nodes[-1].subscriptions.remove(subscription)
+        self.detach(subscription.nodes)
+
+        if not self.subscriptions:
+            self.active.clear()
+
+    def unsubscribe(self, subscriptionID):
+        with self.lock:
+            subscription = self.subscriptions.get(subscriptionID)
+            if subscription is not None:
+                self.remove(subscription)
+
+    def fetch(self, subscriptionID):
+        """Returns and clears the outputs produced since the last fetch, None for an unknown subscription"""
+        with self.lock:
+            subscription = self.subscriptions.get(subscriptionID)
+            if subscription is None:
+                return None
+
+            outputs = list(subscription.outputs)
+            subscription.outputs.clear()
+
+        return outputs
+
+    def control(self, subscriptionID, stageIndex, action, **kwargs):
+        with self.lock:
+            subscription = self.subscriptions[subscriptionID]
+
+            if action == 'configure':
+                return self.configure(subscription, stageIndex % len(subscription.nodes), kwargs)
+
+            return subscription.nodes[stageIndex].stage.control(action, **kwargs)
+
+    def configure(self, subscription, stageIndex, changes):
+        """
+        Changes the settings of one stage of a subscription at run time.
+
+        A stage only this subscription uses is changed in place, so it keeps
+        its state, and moved to its new key. A shared stage is left alone
+        for the other subscribers and the subscription moves to a branch
+        with the new settings instead.
+        """
+        spec = [dict(stageSpec) for stageSpec in subscription.spec]
+        spec[stageIndex].update(changes)
+
+        node = subscription.nodes[stageIndex]
+        key = stage_key(spec[stageIndex])
+        exclusive = all(other.references == 1 for other in subscription.nodes[stageIndex:])
+
+        if exclusive and key not in node.parent.children:
+            node.stage.control('configure', **changes)
+
+            del node.parent.children[node.key]
+            node.key = key
+            node.parent.children[key] = node
+        else:
+            subscription.nodes[-1].subscriptions.remove(subscription)
+            self.detach(subscription.nodes)
+
+            subscription.nodes = self.attach(spec)
+            subscription.nodes[-1].subscriptions.append(subscription)
+
+        subscription.spec = spec
+
+        return None
+
+    def broadcast(self, frame):
+        """Queues a frame for every subscriber, whatever their stages"""
+        with self.lock:
+            for subscription in self.subscriptions.values():
+                subscription.outputs.append(frame)
+
+    def process(self, block):
+        with self.lock:
+            self.process_children(self.root, block)
+
+        self.lastBlock = block
+
+    def process_children(self, node, item):
+        #Each node is evaluated once and its output reused by every subscriber below it
+        for child in list(node.children.values()):
+            try:
+                output = child.stage(item)
+            except Exception as err:
+                self.drop(child, err)
+                continue
+
+            if output is None:
+                continue
+
+            for subscription in child.subscriptions:
+                subscription.outputs.append(output)
+
+            self.process_children(child, output)
+
+
+    def drop(self, node, err):
+        """Removes a failing stage and every subscription that goes through it, leaving its siblings running"""
+        failed = []
+        nodes = [node]
+        while nodes:
+            current = nodes.pop()
+            failed.extend(current.subscriptions)
+            nodes.extend(current.children.values())
+
+        print('[DSP] Stage %s failed, dropping subscriptions %s: %r'%(node.stage.name,
+                                                                      [subscription.id for subscription in failed], err))
+
+        for subscription in failed:
+            self.remove(subscription)
+
+
+class PipelineRunner(threading.Thread):
+    """
+    Feeds blocks from the DAQ handler into the pipeline while anyone is
+    subscribed. In triggered mode each capture is one block, announced to
+    every subscriber by a frame holding its trigger number and time first.
+    """
+    def __init__(self, daq, pipeline):
+        super(PipelineRunner, self).__init__(daemon = True)
+
+        self.daq = daq
+        self.pipeline = pipeline
+
+        #Position and start time of the stream of a direct handler
+        self.stream = None
+        self.position = 0
+        self.streamStart = 0.0
+
+    def read_block(self):
+        #Ring handlers give the absolute position, the direct handler is counted here
+        if hasattr(self.daq, 'read_block'):
+            start, dataArray = self.daq.read_block()
+            ring = self.daq.ring
+            startTime = ring.start_time + (start - ring.generation_start)/ring.sample_frequency
+        else:
+            timeArray, dataArray = self.daq.read_data()
+
+            #Count from the first block, and again whenever the stream changes
+            stream = (self.daq.sampleFrequency, tuple(self.daq.channels))
+            if self.stream != stream:
+                self.stream = stream
+                self.position = 0
+                self.streamStart = time() - dataArray.shape[-1]/self.daq.sampleFrequency
+
+            start = self.position
+            startTime = self.streamStart + start/self.daq.sampleFrequency
+
+        self.position = start + dataArray.shape[-1]
+
+        channels = list(self.daq.channels)
+
+        return Block(np.atleast_2d(dataArray), self.daq.sampleFrequency, channels, start, startTime,
+                     scan_offsets(channels, self.daq.sampleFrequency))
+
+    def read_capture(self):
+        capture = self.daq.read_capture()
+        if capture is None:
+            return None
+
+        generation, start, startTime, dataArray = capture
+        channels = list(self.daq.channels)
+
+        block = Block(dataArray, self.daq.sampleFrequency, channels, start, startTime,
+                      scan_offsets(channels, self.daq.sampleFrequency))
+        self.pipeline.broadcast(frame_for(block, trigger = np.array(generation, dtype = 'float'),
+                                          samples = np.array(dataArray.shape[-1], dtype = 'float')))
+
+        return block
+
+    def run(self):
+        while True:
+            self.pipeline.active.wait()
+
+            try:
+                if getattr(self.daq, 'captureLength', 0) > 0:
+                    block = self.read_capture()
+                    if block is None:
+                        continue
+                else:
+                    block = self.read_block()
+
+            #No data while the acquisition switches between continuous and triggered scans
+            except TimeoutError as err:
+                print('[DSP] Pipeline waiting for data:', err)
+                continue
+
+            except Exception as err:
+                print('[DSP] Pipeline read error:', err)
+                sleep(READ_RETRY)
+                continue
+
+            #Skip the dummy arrays returned after an overrun
+            if block.data.shape[-1] < 2:
+                continue
+
+            try:
+                self.pipeline.process(block)
+            except Exception as err:
+                print('[DSP] Pipeline error:', err)
+
+
+#Shared by the DAQRequestHandler classes of both servers
+class PipelineCommandMixin():
+    """Handlers set pipeline and subscriptionIDs, the ids their client subscribed"""
+    def finish(self):
+        #Stages nobody can fetch from any more would run on every block
+        for subscriptionID in self.subscriptionIDs:
+            self.pipeline.unsubscribe(subscriptionID)
+        self.subscriptionIDs.clear()
+
+        super(PipelineCommandMixin, self).finish()
+
+    def read_json(self):
+        data_len = struct.unpack('<L', self.rfile.read(struct.calcsize('<L')))[0]
+        return json.loads(self.rfile.read(data_len).decode('utf-8'))
+
+    def send_json(self, stream, data):
+        self.send_data(stream, json.dumps(data).encode('utf-8'))
+
+    def send_frame(self, stream, frame):
+        """Sends a JSON header describing the arrays followed by each array"""
+        if isinstance(frame, Block):
+            frame = frame.to_frame()
+
+        arrays = {key: np.ascontiguousarray(value) for key, value in frame.items()}
+        self.send_json(stream, {key: [value.dtype.str, list(value.shape)] for key, value in arrays.items()})
+
+        for value in arrays.values():
+            self.send_data(stream, value)
+
+    def read_pipeline_command(self, command):
+        """Handles the pipeline commands, returns False for any other command"""
+        stream = io.BytesIO()
+
+        if command == COMMAND_SUBSCRIBE:
+            request = self.read_json()
+            try:
+                subscriptionID = self.pipeline.subscribe(request['spec'])
+                self.subscriptionIDs.add(subscriptionID)
+                print(f"[DAQ Server] Client subscribed to {request['spec']}: {self.client_address[0]}:{self.client_address[1]}")
+            except (ValueError, TypeError, KeyError) as err:
+                print('[DAQ Server] Invalid subscription:', err)
+                subscriptionID = -1
+
+            self.send_data(stream, np.array([subscriptionID], dtype = 'float'))
+
+        elif command == COMMAND_FETCH:
+            #-1 when the subscription is unknown or was dropped after a stage failed
+            request = self.read_json()
+            outputs = self.pipeline.fetch(request['id'])
+
+            self.send_data(stream, np.array([-1 if outputs is None else len(outputs)], dtype = 'float'))
+            for output in outputs or []:
+                self.send_frame(stream, output)
+
+        elif command == COMMAND_UNSUBSCRIBE:
+            request = self.read_json()
+            self.pipeline.unsubscribe(request['id'])
+            self.subscriptionIDs.discard(request['id'])
+
+            self.send_data(stream, np.array([request['id']], dtype = 'float'))
+
+        elif command == COMMAND_CONTROL:
+            request = self.read_json()
+            try:
+                frame = self.pipeline.control(request['id'], request.get('stage', -1),
+                                              request['action'], **request.get('arguments', {}))
+            except (ValueError, TypeError, KeyError, IndexError) as err:
+                print('[DAQ Server] Invalid control command:', err)
+                frame = None
+
+            self.send_frame(stream, frame if frame is not None else {})
+
+        elif command == COMMAND_TELEMETRY:
+            #Vehicle state forwarded by the ROS client, the reply is the number of samples stored
+            request = self.read_json()
+            try:
+                stored = TELEMETRY.add(request['source'], request['time'], request['values'], request.get('sent'))
+            except (ValueError, TypeError, KeyError) as err:
+                print('[DAQ Server] Invalid telemetry:', err)
+                stored = -1
+
+            self.send_data(stream, np.array([stored], dtype = 'float'))
+
+        elif command == COMMAND_TRIGGER:
+            #Switch the acquisition to triggered captures, or back to continuous with a null mode
+            request = self.read_json()
+            try:
+                self.daq.change_trigger_settings(request.get('mode'), int(request.get('samples', 0)))
+                print(f"[DAQ Server] Client set trigger {request}: {self.client_address[0]}:{self.client_address[1]}")
+                accepted = 1
+            except (AttributeError, ValueError, TypeError) as err:
+                print('[DAQ Server] Invalid trigger command:', err)
+                accepted = -1
+
+            self.send_data(stream, np.array([accepted], dtype = 'float'))
+
+        else:
+            return False
+
+        return True
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+
+"""
+    Process pool for DSP work that should not run in the request threads.
+
+    Blocks are handed to the workers by shared-memory handle rather than as
+    pickled arrays - either a (start, count) range in the acquisition ring,
+    which every worker attaches to when it starts, or a temporary shared
+    memory block for data that does not come from the ring. Every call
+    returns a concurrent.futures.Future so callers can wait on or chain the
+    result.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from shared_ring import SharedRing, RING_NAME
+from spectral import SpectralEngine
+from acquisition_process import ACQUISITION_CPU
+
+
+#Ring attached by each worker process
+_RING = None
+
+
+def _init_worker(ringName, reservedCpu):
+    global _RING
+
+    #Keep the workers off the acquisition core
+    try:
+        cpus = os.sched_getaffinity(0) - {reservedCpu}
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+    except (AttributeError, OSError):
+        pass
+
+    if ringName is not None:
+        try:
+            _RING = SharedRing(ringName, readOnly = True)
+        except FileNotFoundError:
+            _RING = None
+
+
+def _ring_task(function, start, count, kwargs):
+    dataArray = _RING.read(start, count)
+
+    return function(dataArray, **kwargs)
+
+
+def _array_task(function, name, shape, dtype, kwargs):
+    shm = shared_memory.SharedMemory(name = name)
+
+    dataArray = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+
+    #Tasks must return new arrays, not views of the shared block
+    try:
+        return function(dataArray, **kwargs)
+    finally:
+        del dataArray
+        shm.close()
+
+
+#DSP tasks - all take a (channels, samples) array as the first argument
+def welch_task(dataArray, fs, nperseg, window = 'hann'):
+    #One FFT thread per worker, the processes already cover the free cores
+    return SpectralEngine(fs, nperseg, window, workers = 1).welch(dataArray)
+
+
+class DSPPool():
+    def __init__(self, workers = None, ringName = RING_NAME, reservedCpu = ACQUISITION_CPU):
+        """
+        Args:
+            workers (int): Number of worker processes. Defaults to one per
+                core not used by the acquisition process.
+            ringName (str): Shared ring the workers attach to, or None.
+            reservedCpu (int): Core the workers must not run on.
+        """
+        if workers is None:
+            workers = max(1, (os.cpu_count() or 4) - 1)
+
+        self.executor = ProcessPoolExecutor(max_workers = workers, initializer = _init_worker,
+                                            initargs = (ringName, reservedCpu))
+
+        print('[DSP] Started worker pool with %d processes'%workers)
+
+    def submit_ring(self, function, start, count, **kwargs):
+        """Runs function on frames [start, start + count) of the shared ring"""
+        return self.executor.submit(_ring_task, function, start, count, kwargs)
+
+    def submit_array(self, function, dataArray, **kwargs):
+        """Runs function on an array that is not in the ring via a temporary shared block"""
+        dataArray = np.ascontiguousarray(dataArray)
+
+        shm = shared_memory.SharedMemory(create = True, size = max(1, dataArray.nbytes))
+        np.ndarray(dataArray.shape, dtype = dataArray.dtype, buffer = shm.buf)[...] = dataArray
+
+        future = self.executor.submit(_array_task, function, shm.name, dataArray.shape,
+                                      dataArray.dtype.str, kwargs)
+
+        #Free the block once the worker is done with it
+        def release(_):
+            shm.close()
+            shm.unlink()
+
+        future.add_done_callback(release)
+
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait = True, cancel_futures = True)
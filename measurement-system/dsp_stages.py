@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+
+"""
+    Basic stages for the streaming DSP pipeline. Importing this module
+    registers them with dsp_pipeline.
+"""
+
+from fractions import Fraction
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import signal, fft
+
+from dsp_pipeline import Stage, register_stage, frame_for, scan_offsets, channel_rows
+from telemetry import TELEMETRY, TelemetryWait
+
+
+#Corner of the DC block before the vibration canceller (Hz)
+DC_BLOCK_FREQUENCY = 0.5
+
+
+def per_channel(value, numChannels):
+    """Broadcasts a scalar or per-channel setting to a (channels, 1) column"""
+    return np.broadcast_to(np.asarray(value, dtype = 'float').reshape(-1, 1), (numChannels, 1))
+
+
+def design_sos(spec, sampleFrequency):
+    """
+    Second order sections for one IIR filter of a chain:
+        {"sos": [[b0, b1, b2, a0, a1, a2], ...]}
+        {"kind": "highpass", "cutoff": 0.5, "order": 4, "design": "butter"}
+        {"notch": 50.0, "quality": 30.0}
+    """
+    if 'sos' in spec:
+        return np.atleast_2d(np.asarray(spec['sos'], dtype = 'float'))
+
+    if 'notch' in spec:
+        b, a = signal.iirnotch(spec['notch'], spec.get('quality', 30.0), fs = sampleFrequency)
+        return signal.tf2sos(b, a)
+
+    order = spec.get('order', 4)
+    kind = spec.get('kind', 'lowpass')
+    design = spec.get('design', 'butter')
+
+    if design == 'butter':
+        return signal.butter(order, spec['cutoff'], btype = kind, fs = sampleFrequency, output = 'sos')
+    if design == 'bessel':
+        return signal.bessel(order, spec['cutoff'], btype = kind, fs = sampleFrequency, output = 'sos')
+    if design == 'cheby1':
+        return signal.cheby1(order, spec.get('ripple', 0.1), spec['cutoff'], btype = kind,
+                             fs = sampleFrequency, output = 'sos')
+
+    raise ValueError('Unknown filter design %s'%design)
+
+
+@register_stage
+class FilterStage(Stage):
+    """
+    Chain of IIR filters and an optional FIR, with the state carried between
+    blocks so there are no edge transients. The IIR filters are given as a
+    single filter spec or a 'filters' list (see design_sos) and run as one
+    cascade of second order sections; 'fir' gives FIR taps. 'channels'
+    limits the filter to some MCC channel numbers, the others pass through.
+    The chain can be changed with a configure command without restarting
+    the scan.
+    """
+    name = 'filter'
+
+    def setup(self, block):
+        self.design(block.sampleFrequency, block.channels, block.data[:, 0])
+
+    def design(self, sampleFrequency, channels, lastSamples):
+        filters = self.params.get('filters', [self.params] if ('cutoff' in self.params or 'notch' in self.params
+                                                               or 'sos' in self.params) else [])
+
+        self.sos = np.vstack([design_sos(spec, sampleFrequency) for spec in filters]) if filters else None
+        self.fir = np.asarray(self.params['fir'], dtype = 'float') if 'fir' in self.params else None
+
+        selected = self.params.get('channels')
+        self.selected = slice(None) if selected is None else channel_rows(channels, selected)
+
+        #Start from steady state on the given samples to avoid a step transient
+        lastSamples = np.asarray(lastSamples, dtype = 'float')[self.selected]
+        if self.sos is not None:
+            self.zi = signal.sosfilt_zi(self.sos)[:, None, :]*lastSamples[None, :, None]
+        if self.fir is not None:
+            self.history = np.repeat(lastSamples[:, None], len(self.fir) - 1, axis = -1)
+
+        self.lastSamples = lastSamples
+
+    def process(self, block):
+        data = block.data[self.selected]
+        self.lastSamples = data[:, -1]
+
+        if self.sos is not None:
+            data, self.zi = signal.sosfilt(self.sos, data, axis = -1, zi = self.zi)
+
+        if self.fir is not None:
+            buffer = np.concatenate((self.history, data), axis = -1)
+            self.history = buffer[:, buffer.shape[-1] - (len(self.fir) - 1):]
+            data = signal.oaconvolve(buffer, self.fir[None, :], mode = 'valid', axes = -1)
+
+        if isinstance(self.selected, slice):
+            return block.replace(data = data)
+
+        output = block.data.copy()
+        output[self.selected] = data
+
+        return block.replace(data = output)
+
+    def control(self, action, **kwargs):
+        #Redesign in place and carry on from the last input, the scan keeps running
+        if action == 'configure' and self.configuration is not None:
+            self.params.update(kwargs)
+
+            lastSamples = np.zeros(len(self.configuration[1]))
+            lastSamples[self.selected] = self.lastSamples
+            self.design(self.configuration[0], self.configuration[1], lastSamples)
+            return None
+
+        return super(FilterStage, self).control(action, **kwargs)
+
+
+class PolyphaseResampler():
+    def __init__(self, numChannels, up, down, firstSamples = None):
+        """
+        Streaming rational resampler by up/down with a polyphase FIR.
+
+        Only the output samples that are kept are computed, each from the
+        one polyphase branch that contributes to it, and the input history
+        needed by the next block is carried over. The filter is the Kaiser
+        design used by signal.resample_poly.
+
+        Args:
+            up, down (int): Resampling ratio.
+            firstSamples (array): First value of each channel, used to fill
+                the history so the stream starts without a step transient.
+        """
+        self.up = int(up)
+        self.down = int(down)
+
+        maxRate = max(self.up, self.down)
+        self.halfLength = 10*maxRate
+        taps = signal.firwin(2*self.halfLength + 1, 1.0/maxRate, window = ('kaiser', 5.0))*self.up
+
+        #Branch p holds taps p, p + up, p + 2up ... reversed to line up with the input windows
+        self.branchLength = -(-len(taps)//self.up)
+        branches = np.zeros(self.up*self.branchLength)
+        branches[:len(taps)] = taps
+        self.branches = branches.reshape(self.branchLength, self.up).T[:, ::-1]
+
+        #Delay of the filter in output samples, for the time stamps
+        self.delay = self.halfLength/self.down
+
+        fill = np.zeros(numChannels) if firstSamples is None else np.asarray(firstSamples, dtype = 'float')
+        self.history = np.repeat(fill[:, None], self.branchLength - 1, axis = -1)
+
+        #Absolute input index of history[0], and the next output to produce
+        self.historyStart = -(self.branchLength - 1)
+        self.nextOutput = 0
+
+    def process(self, data):
+        buffer = np.concatenate((self.history, np.atleast_2d(data)), axis = -1)
+        inputEnd = self.historyStart + buffer.shape[-1]
+
+        #Outputs whose newest input sample has arrived
+        lastOutput = ((inputEnd - 1)*self.up)//self.down
+        outputs = np.arange(self.nextOutput, lastOutput + 1)
+
+        newest = (outputs*self.down)//self.up - self.historyStart
+        phases = (outputs*self.down) % self.up
+
+        windows = sliding_window_view(buffer, self.branchLength, axis = -1)[:, newest - self.branchLength + 1]
+        resampled = np.einsum('cmj,mj->cm', windows, self.branches[phases])
+
+        #Keep what the next output needs
+        self.nextOutput = lastOutput + 1
+        keepFrom = (self.nextOutput*self.down)//self.up - (self.branchLength - 1)
+        self.history = buffer[:, keepFrom - self.historyStart:]
+        self.historyStart = keepFrom
+
+        return outputs, resampled
+
+
+@register_stage
+class DecimateStage(Stage):
+    """
+    Polyphase anti-alias decimation or rational resampling to the output
+    'rate' in Hz, or by an integer 'factor'. Subscribers asking for the
+    same rate share one resampler.
+    """
+    name = 'decimate'
+
+    def setup(self, block):
+        if 'rate' in self.params:
+            ratio = Fraction(float(self.params['rate'])/block.sampleFrequency).limit_denominator(1000)
+        else:
+            ratio = Fraction(1, int(self.params['factor']))
+
+        self.resampler = PolyphaseResampler(block.data.shape[0], ratio.numerator, ratio.denominator,
+                                            block.data[:, 0])
+        self.outputFrequency = block.sampleFrequency*ratio.numerator/ratio.denominator
+        self.originTime = block.startTime
+
+    def process(self, block):
+        outputs, data = self.resampler.process(block.data)
+        if len(outputs) == 0:
+            return None
+
+        #Output time stamps are corrected for the delay of the filter
+        return block.replace(data = data, sampleFrequency = self.outputFrequency, start = int(outputs[0]),
+                             startTime = self.originTime + (outputs[0] - self.resampler.delay)/self.outputFrequency)
+
+
+@register_stage
+class DeskewStage(Stage):
+    """
+    Aligns the channels of the multiplexed scan onto the time base of the
+    last converted channel with a windowed-sinc fractional delay per
+    channel ('taps' long, state carried across blocks). The output time
+    stamps include the integer latency of the filters.
+    """
+    name = 'deskew'
+
+    def setup(self, block):
+        offsets = block.channelOffsets
+        if offsets is None:
+            offsets = scan_offsets(block.channels, block.sampleFrequency)
+
+        tapNumber = int(self.params.get('taps', 16))
+        self.latency = tapNumber//2
+
+        #Delay of each channel, in samples, up to the latest one in the scan
+        fractions = (np.max(offsets) - np.asarray(offsets))*block.sampleFrequency
+
+        n = np.arange(tapNumber)
+        taps = np.sinc(n[None, :] - self.latency + fractions[:, None])*signal.get_window(('kaiser', 6.0), tapNumber)
+        taps /= taps.sum(axis = -1, keepdims = True)
+
+        #Reversed to line up with the input windows
+        self.taps = taps[:, ::-1]
+        self.history = np.repeat(block.data[:, :1], tapNumber - 1, axis = -1)
+        self.alignedOffset = np.max(offsets)
+
+    def process(self, block):
+        buffer = np.concatenate((self.history, block.data), axis = -1)
+        self.history = buffer[:, block.data.shape[-1]:]
+
+        windows = sliding_window_view(buffer, self.taps.shape[-1], axis = -1)
+        data = np.einsum('cmn,cn->cm', windows, self.taps)
+
+        return block.replace(data = data, channelOffsets = np.zeros(len(block.channels)),
+                             startTime = block.startTime + self.alignedOffset - self.latency/block.sampleFrequency)
+
+
+class FrequencyDomainLMS():
+    def __init__(self, numChannels, numReferences, taps = 128, stepSize = 0.2, smoothing = 0.9,
+                 regularisation = 0.1):
+        """
+        Adaptive canceller updated with the constrained overlap-save
+        frequency domain LMS, for all channel/reference pairs at once.
+
+        Each call takes one block of taps samples. The output of the filters
+        on the references is removed from the channels. The step of each bin
+        is normalised by the reference power in that bin summed over the
+        references, never less than the power of the current block, plus
+        regularisation times the strongest bin. The floor keeps the bins a
+        tone only leaks into from taking huge steps, which made low tones
+        (below one bin, fs/(2 taps)) diverge.
+
+        If the error ever grows well beyond the channels the filters are
+        cleared rather than left to run away.
+        """
+        self.taps = int(taps)
+        self.stepSize = stepSize
+        self.smoothing = smoothing
+        self.regularisation = regularisation
+
+        self.weights = np.zeros((numChannels, numReferences, self.taps + 1), dtype = 'complex128')
+        self.previous = np.zeros((numReferences, self.taps))
+        self.power = None
+
+    def reset(self):
+        self.weights[:] = 0
+        self.power = None
+
+    def process(self, desired, reference):
+        buffer = np.concatenate((self.previous, reference), axis = -1)
+        self.previous = reference
+
+        X = fft.rfft(buffer, axis = -1)
+        estimate = fft.irfft(np.einsum('crk,rk->ck', self.weights, X), n = 2*self.taps, axis = -1)[:, self.taps:]
+        error = desired - estimate
+
+        #Diverging - start again from no cancellation
+        if np.sum(error**2) > 100*np.sum(desired**2) + 1e-12:
+            print('[DSP] Vibration canceller diverged, resetting')
+            self.reset()
+            return desired
+
+        power = np.sum(np.abs(X)**2, axis = 0)
+        if self.power is None:
+            self.power = power
+        else:
+            self.power = np.maximum(self.smoothing*self.power + (1 - self.smoothing)*power, power)
+
+        E = fft.rfft(np.concatenate((np.zeros_like(error), error), axis = -1), axis = -1)
+
+        normalisation = 1.0/(self.power + self.regularisation*self.power.max() + 1e-12)
+        gradient = fft.irfft(X.conj()[None, :, :]*E[:, None, :]*normalisation, n = 2*self.taps, axis = -1)
+
+        #Gradient constraint - keep the causal half so the filters stay linear convolutions
+        gradient[..., self.taps:] = 0
+
+        self.weights += self.stepSize*fft.rfft(gradient, axis = -1)
+
+        return error
+
+
+@register_stage
+class VibrationCancelStage(Stage):
+    """
+    Removes the part of the 'channels' (MCC channel numbers, all by
+    default) that is correlated with the vehicle IMU forwarded by the ROS
+    client, with a frequency domain LMS canceller ('taps', 'stepSize') per
+    channel and 'reference' column of the 'source' telemetry. The IMU is interpolated
+    onto the sample times, so only vibration below its Nyquist frequency
+    can be cancelled, and nothing below DC_BLOCK_FREQUENCY (gravity, the
+    offsets of the channels). Samples are held until the IMU covering them
+    has arrived and output in blocks of taps samples; samples the IMU is
+    more than 'maxAge' seconds behind pass through unchanged.
+    """
+    name = 'vibration_cancel'
+
+    def setup(self, block):
+        selected = self.params.get('channels')
+        self.selected = np.arange(block.data.shape[0]) if selected is None else channel_rows(block.channels, selected)
+        self.references = list(self.params.get('reference', [0, 1, 2]))
+
+        self.canceller = FrequencyDomainLMS(len(self.selected), len(self.references), self.params.get('taps', 128),
+                                            self.params.get('stepSize', 0.2), self.params.get('smoothing', 0.9))
+
+        #The canceller adapts on DC blocked references and channels so gravity and the
+        #offsets of the channels neither get cancelled nor disturb the adaptation
+        self.dcBlock = ([1, -1], [1, -np.exp(-2*np.pi*DC_BLOCK_FREQUENCY/block.sampleFrequency)])
+        self.referenceState = None
+        self.channelState = None
+
+        #Samples wait for the IMU that covers them, in whole blocks of taps
+        self.wait = TelemetryWait([self.params.get('source', 'imu')], self.params.get('maxAge', 0.5),
+                                  self.canceller.taps)
+
+    def dc_block(self, data, state):
+        if state is None:
+            state = signal.lfilter_zi(*self.dcBlock)*data[:, :1]
+
+        return signal.lfilter(*self.dcBlock, data, axis = -1, zi = state)
+
+    def process(self, block):
+        ready, stale = self.wait.push(block)
+
+        #No IMU for maxAge - let the samples through as they are and start the DC blocks again
+        if stale is not None:
+            self.referenceState = None
+            self.channelState = None
+            return stale
+
+        if ready is None:
+            return None
+
+        sampleNumber = ready.data.shape[-1]
+        times = ready.startTime + np.arange(sampleNumber)/ready.sampleFrequency
+        reference = TELEMETRY.interpolate(self.wait.sources[0], times)[:, self.references].T
+        reference, self.referenceState = self.dc_block(reference, self.referenceState)
+
+        output = ready.data.copy()
+        desired, self.channelState = self.dc_block(output[self.selected], self.channelState)
+
+        taps = self.canceller.taps
+        for first in range(0, sampleNumber, taps):
+            error = self.canceller.process(desired[:, first:first + taps], reference[:, first:first + taps])
+            output[self.selected, first:first + taps] -= desired[:, first:first + taps] - error
+
+        return ready.replace(data = output)
+
+
+@register_stage
+class CalibrateStage(Stage):
+    """Linear calibration, gain and offset are scalars or one value per channel"""
+    name = 'calibrate'
+
+    def setup(self, block):
+        numChannels = block.data.shape[0]
+        self.gain = per_channel(self.params.get('gain', 1.0), numChannels)
+        self.offset = per_channel(self.params.get('offset', 0.0), numChannels)
+
+    def process(self, block):
+        return block.replace(data = block.data*self.gain + self.offset)
+
+
+@register_stage
+class WindowStage(Stage):
+    name = 'window'
+
+    def setup(self, block):
+        self.window = None
+
+    def process(self, block):
+        sampleNumber = block.data.shape[-1]
+
+        if self.window is None or len(self.window) != sampleNumber:
+            self.window = signal.get_window(self.params.get('window', 'hann'), sampleNumber)
+
+        return block.replace(data = block.data*self.window)
+
+
+@register_stage
+class LevelStage(Stage):
+    """RMS of each block and its level in dB relative to reference"""
+    name = 'level'
+
+    def process(self, block):
+        rms = np.sqrt(np.mean(block.data**2, axis = -1))
+        reference = self.params.get('reference', 1.0)
+
+        with np.errstate(divide = 'ignore'):
+            level = 20*np.log10(rms/reference)
+
+        return frame_for(block, rms = rms, level = level)
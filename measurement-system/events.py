@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+
+"""
+    Software event trigger on the continuous stream. Conditions are checked
+    on every block and each trigger captures a pre and post-trigger window
+    of all channels, so only the interesting snippets are sent or stored.
+    Importing this module registers the stage with dsp_pipeline.
+"""
+
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+from scipy import signal
+
+from dsp_pipeline import Stage, register_stage
+
+
+#Events are only recorded here
+EVENT_DIR = Path('/home/vki/Documents/Data/events')
+
+#Number of events kept for the query control action
+EVENT_HISTORY = 32
+
+SLOPES = ('rising', 'falling', 'either')
+
+
+class TriggerCondition():
+    def __init__(self, spec, channels, sampleFrequency):
+        """
+        One trigger condition on one channel of the stream:
+            {"type": "threshold", "channel": 0, "level": 1.0, "slope": "rising"}
+            {"type": "band", "channel": 1, "band": [500, 1500], "level": 0.1, "window": 0.05}
+            {"type": "level", "channel": 0, "level": 94.0, "reference": 2e-5, "window": 0.125}
+
+        A threshold triggers when the signal crosses level with the given
+        slope. Band and level conditions trigger when the RMS (in the band,
+        or in dB re reference for level) rises above level, with the mean
+        square smoothed over window seconds.
+        """
+        self.kind = spec.get('type', 'threshold')
+        self.index = list(channels).index(spec['channel'])
+        self.slope = spec.get('slope', 'rising')
+        self.sos = None
+
+        if self.slope not in SLOPES:
+            raise ValueError('Unknown trigger slope %s'%self.slope)
+
+        if self.kind == 'threshold':
+            self.level = float(spec['level'])
+
+        elif self.kind in ('band', 'level'):
+            #Compared as a mean square so the detector never takes a square root or log
+            if self.kind == 'band':
+                self.sos = signal.butter(4, spec['band'], btype = 'bandpass', fs = sampleFrequency, output = 'sos')
+                self.zi = np.zeros((self.sos.shape[0], 2))
+                self.level = float(spec['level'])**2
+            else:
+                self.level = (spec.get('reference', 2e-5)*10**(spec['level']/20.0))**2
+
+            self.slope = 'rising'
+            decay = np.exp(-1.0/(spec.get('window', 0.125)*sampleFrequency))
+            self.smoothing = ([1 - decay], [1, -decay])
+            self.smoothingState = np.zeros(1)
+
+        else:
+            raise ValueError('Unknown trigger condition %s'%self.kind)
+
+        self.previous = None
+
+    def detector(self, data):
+        """Signal the level is compared with"""
+        values = data[self.index]
+        if self.kind == 'threshold':
+            return values
+
+        if self.sos is not None:
+            values, self.zi = signal.sosfilt(self.sos, values, zi = self.zi)
+
+        smoothed, self.smoothingState = signal.lfilter(*self.smoothing, values**2, zi = self.smoothingState)
+
+        return smoothed
+
+    def crossings(self, data):
+        """Indices in the block where the condition becomes true"""
+        values = self.detector(data)
+        if self.previous is None:
+            self.previous = values[0]
+
+        before = np.concatenate(([self.previous], values[:-1]))
+        self.previous = values[-1]
+
+        rising = (before < self.level) & (values >= self.level)
+        falling = (before > self.level) & (values <= self.level)
+
+        if self.slope == 'rising':
+            return np.flatnonzero(rising)
+        if self.slope == 'falling':
+            return np.flatnonzero(falling)
+
+        return np.flatnonzero(rising | falling)
+
+
+class EventCapture():
+    def __init__(self, numChannels, pre, post, holdoff):
+        """
+        Cuts pre + post sample windows around trigger positions out of the
+        stream. The last pre samples are kept between blocks and windows
+        that run past the end of a block are completed by the next ones.
+        Triggers within holdoff samples of the previous one are ignored.
+        """
+        self.pre = int(pre)
+        self.post = int(post)
+        self.holdoff = int(holdoff)
+
+        self.history = np.zeros((numChannels, 0))
+        self.historyStart = 0
+        self.pending = []
+        self.rearm = -np.inf
+
+    def process(self, data, start, triggers):
+        """
+        Adds a block starting at absolute index start with the (position,
+        information) of the triggers found in it, returns the (position,
+        information, window) of the events completed by this block.
+        """
+        if self.history.shape[-1] == 0:
+            self.historyStart = start
+
+        buffer = np.concatenate((self.history, data), axis = -1)
+        end = start + data.shape[-1]
+
+        for trigger, information in triggers:
+            if trigger < self.rearm:
+                continue
+
+            self.rearm = trigger + self.holdoff
+
+            #Missing pre-trigger samples at the start of the stream are NaN
+            first = max(trigger - self.pre, self.historyStart)
+            window = np.full((data.shape[0], self.pre + self.post), np.nan)
+            self.pending.append([trigger, information, window, first])
+
+        completed = []
+        for event in self.pending:
+            trigger, information, window, first = event
+
+            last = min(trigger + self.post, end)
+            window[:, first - trigger + self.pre:last - trigger + self.pre] = \
+                buffer[:, first - self.historyStart:last - self.historyStart]
+            event[3] = last
+
+            if last == trigger + self.post:
+                completed.append((trigger, information, window))
+
+        self.pending = [event for event in self.pending if event[3] < event[0] + self.post]
+
+        keep = min(self.pre, buffer.shape[-1])
+        self.history = buffer[:, buffer.shape[-1] - keep:]
+        self.historyStart = end - keep
+
+        return completed
+
+
+@register_stage
+class EventTriggerStage(Stage):
+    """
+    Captures 'pre' seconds before and 'post' seconds after each trigger of
+    any of the 'conditions' (see TriggerCondition). Triggers are ignored
+    for 'holdoff' seconds after one, by default the post window. Blocks
+    that complete events output them stacked as (events, channels,
+    samples) with the trigger time and the condition that fired; blocks
+    without output nothing. With 'record' set each event is also saved to
+    EVENT_DIR. Control actions: query (the last events), reset.
+    """
+    name = 'event_trigger'
+
+    def setup(self, block):
+        fs = block.sampleFrequency
+        self.conditions = [TriggerCondition(spec, block.channels, fs) for spec in self.params['conditions']]
+
+        post = self.params.get('post', 0.1)
+        self.capture = EventCapture(block.data.shape[0], self.params.get('pre', 0.1)*fs, post*fs,
+                                    self.params.get('holdoff', post)*fs)
+        self.events = deque(maxlen = EVENT_HISTORY)
+
+    def frame(self, events):
+        return {'sampleFrequency': np.array(self.configuration[0]),
+                'channels': np.array(self.configuration[1], dtype = 'float'),
+                'pre': np.array(self.capture.pre, dtype = 'float'),
+                'triggerIndex': np.array([event[0] for event in events], dtype = 'float'),
+                'triggerTime': np.array([event[1] for event in events]),
+                'condition': np.array([event[2] for event in events], dtype = 'float'),
+                'events': np.array([event[3] for event in events]).reshape(len(events), len(self.configuration[1]),
+                                                                            self.capture.pre + self.capture.post)}
+
+    def process(self, block):
+        #Sample each condition fires at, the first condition listed wins a tie
+        conditions = {}
+        for number, condition in enumerate(self.conditions):
+            for index in condition.crossings(block.data):
+                conditions.setdefault(int(index), number)
+
+        triggers = [(block.start + index, (block.startTime + index/block.sampleFrequency, conditions[index]))
+                    for index in sorted(conditions)]
+
+        completed = self.capture.process(block.data, block.start, triggers)
+        if not completed:
+            return None
+
+        events = [(trigger, triggerTime, condition, window) for trigger, (triggerTime, condition), window in completed]
+        self.events.extend(events)
+
+        if self.params.get('record', False):
+            self.record(events)
+
+        return self.frame(events)
+
+    def record(self, events):
+        EVENT_DIR.mkdir(parents = True, exist_ok = True)
+
+        for trigger, triggerTime, condition, window in events:
+            fileName = EVENT_DIR / ('event_%s.npz'%datetime.fromtimestamp(triggerTime).strftime('%Y%m%d_%H%M%S_%f'))
+            np.savez(fileName, data = window, triggerTime = triggerTime, condition = condition,
+                     sampleFrequency = self.configuration[0], channels = self.configuration[1], pre = self.capture.pre)
+
+        print('[DSP] Recorded %d events'%len(events))
+
+    def result(self):
+        return self.frame(list(self.events))
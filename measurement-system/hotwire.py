@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+
+"""
+    Hotwire stages - turbulence statistics computed on the Pi so a flight
+    does not need the full time series on the ground. Importing this module
+    registers the stages with dsp_pipeline.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+from scipy import fft
+
+from dsp_pipeline import Stage, register_stage, frame_for, channel_rows
+from spectral import StreamingWelch, AVERAGE_EXPONENTIAL
+from telemetry import TELEMETRY, TelemetryWait
+
+
+#Calibration files are only read from here
+CALIBRATION_DIR = Path('/home/vki/Documents/Data/calibration')
+
+#MCC 128 converter resolution
+ADC_BITS = 16
+
+
+class StreamingMoments():
+    def __init__(self, numChannels):
+        """
+        Running mean and central moments up to fourth order per channel.
+
+        Each block is reduced to its own moments and merged with the running
+        totals using the pairwise update formulas (Chan et al., Pebay), which
+        stay accurate for large means and arbitrarily long runs.
+        """
+        self.numChannels = numChannels
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = np.zeros(self.numChannels)
+        self.M2 = np.zeros(self.numChannels)
+        self.M3 = np.zeros(self.numChannels)
+        self.M4 = np.zeros(self.numChannels)
+
+    def update(self, data):
+        data = np.atleast_2d(data)
+        nB = data.shape[-1]
+        if nB == 0:
+            return
+
+        meanB = data.mean(axis = -1)
+        deviation = data - meanB[:, None]
+        squared = deviation**2
+        M2B = squared.sum(axis = -1)
+        M3B = (squared*deviation).sum(axis = -1)
+        M4B = (squared**2).sum(axis = -1)
+
+        nA = self.count
+        n = nA + nB
+        delta = meanB - self.mean
+
+        M2 = self.M2 + M2B + delta**2*nA*nB/n
+        M3 = (self.M3 + M3B + delta**3*nA*nB*(nA - nB)/n**2
+              + 3*delta*(nA*M2B - nB*self.M2)/n)
+        M4 = (self.M4 + M4B + delta**4*nA*nB*(nA**2 - nA*nB + nB**2)/n**3
+              + 6*delta**2*(nA**2*M2B + nB**2*self.M2)/n**2
+              + 4*delta*(nA*M3B - nB*self.M3)/n)
+
+        self.mean = self.mean + delta*nB/n
+        self.M2, self.M3, self.M4 = M2, M3, M4
+        self.count = n
+
+    def statistics(self):
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            variance = self.M2/max(self.count - 1, 1)
+            skewness = np.sqrt(self.count)*self.M3/self.M2**1.5
+            flatness = self.count*self.M4/self.M2**2
+            intensity = np.sqrt(variance)/np.abs(self.mean)
+
+        return {'count': np.array(self.count, dtype = 'float'), 'mean': self.mean.copy(),
+                'variance': variance, 'skewness': skewness, 'flatness': flatness,
+                'intensity': intensity}
+
+
+class ChannelPDF():
+    """Fixed bin histogram per channel, normalised to a probability density on request"""
+    def __init__(self, numChannels, lowest, highest, binNumber = 100):
+        self.numChannels = numChannels
+        self.lowest = np.broadcast_to(np.asarray(lowest, dtype = 'float'), (numChannels,))[:, None]
+        self.highest = np.broadcast_to(np.asarray(highest, dtype = 'float'), (numChannels,))[:, None]
+        self.binNumber = int(binNumber)
+
+        self.counts = np.zeros((numChannels, self.binNumber), dtype = 'int64')
+        self.outside = np.zeros(numChannels, dtype = 'int64')
+
+    def add(self, data):
+        position = (np.atleast_2d(data) - self.lowest)/(self.highest - self.lowest)*self.binNumber
+        inside = (position >= 0) & (position < self.binNumber)
+
+        bins = position.astype(int) + self.binNumber*np.arange(self.numChannels)[:, None]
+
+        self.counts += np.bincount(bins[inside], minlength = self.counts.size).reshape(self.counts.shape)
+        self.outside += (~inside).sum(axis = -1)
+
+    def density(self):
+        width = (self.highest - self.lowest)/self.binNumber
+        total = self.counts.sum(axis = -1, keepdims = True) + self.outside[:, None]
+
+        return self.counts/(np.maximum(total, 1)*width)
+
+    def edges(self):
+        return self.lowest + (self.highest - self.lowest)*np.arange(self.binNumber + 1)/self.binNumber
+
+    def reset(self):
+        self.counts[:] = 0
+        self.outside[:] = 0
+
+
+def calibration_curve(curve):
+    """
+    Returns a function converting bridge voltage to velocity for one curve:
+        {"type": "king", "A": .., "B": .., "n": ..}    E^2 = A + B U^n
+        {"type": "polynomial", "coefficients": [..]}   U = polyval(coefficients, E)
+    """
+    if curve['type'] == 'king':
+        A, B, n = curve['A'], curve['B'], curve['n']
+
+        def king(voltage):
+            with np.errstate(invalid = 'ignore'):
+                return np.where(voltage**2 > A, ((voltage**2 - A)/B)**(1/n), np.nan)
+
+        return king
+
+    if curve['type'] == 'polynomial':
+        return lambda voltage: np.polyval(curve['coefficients'], voltage)
+
+    raise ValueError('Unknown calibration type %s'%curve['type'])
+
+
+def load_calibration(fileName):
+    """Reads a list of per-channel curves from a JSON file in CALIBRATION_DIR"""
+    with open(CALIBRATION_DIR / Path(fileName).name) as f:
+        return json.load(f)
+
+
+class CalibrationTable():
+    def __init__(self, curves, inputRange = 5.0, bits = ADC_BITS):
+        """
+        Voltage to velocity lookup table for every channel, evaluated once at
+        each code of the converter over +/- inputRange volts.
+
+        Blocks in volts are converted with a linear interpolation between
+        neighbouring codes, which is exact to well below the ADC resolution
+        and much cheaper than evaluating the curves. Raw converter codes
+        index the table directly.
+        """
+        self.inputRange = float(inputRange)
+        self.codeNumber = 2**bits
+        self.lsb = 2*self.inputRange/self.codeNumber
+
+        voltage = -self.inputRange + self.lsb*np.arange(self.codeNumber)
+        table = np.vstack([calibration_curve(curve)(voltage) for curve in curves])
+
+        #Flat tables of value and slope per code so a conversion is two np.take calls
+        self.table = table.ravel()
+        self.slope = np.diff(table, axis = -1, append = table[:, -1:]).ravel()
+        self.rowOffset = self.codeNumber*np.arange(len(curves))[:, None]
+
+    def convert(self, data):
+        position = np.clip((data + self.inputRange)/self.lsb, 0, self.codeNumber - 1)
+        index = position.astype(int)
+        position -= index
+        index += self.rowOffset
+
+        return np.take(self.table, index) + position*np.take(self.slope, index)
+
+    def convert_codes(self, codes):
+        return np.take(self.table, np.asarray(codes, dtype = int) + self.rowOffset)
+
+
+@register_stage
+class VelocityStage(Stage):
+    """
+    Hotwire voltages to velocity through a per-channel calibration table.
+    Curves come from 'curves' in the subscription or from 'file' in
+    CALIBRATION_DIR. Set 'raw' if the blocks hold converter codes.
+    """
+    name = 'velocity'
+
+    def setup(self, block):
+        curves = self.params['curves'] if 'curves' in self.params else load_calibration(self.params['file'])
+
+        if len(curves) != block.data.shape[0]:
+            raise ValueError('Need one calibration curve per channel')
+
+        self.table = CalibrationTable(curves, self.params.get('range', 5.0))
+
+    def process(self, block):
+        if self.params.get('raw', False):
+            return block.replace(data = self.table.convert_codes(block.data))
+
+        return block.replace(data = self.table.convert(block.data))
+
+
+def rotate(quaternions, vector):
+    """Rotates a body frame vector by each (x, y, z, w) quaternion of an (n, 4) array"""
+    q = quaternions[:, :3]
+    w = quaternions[:, 3:]
+    t = 2*np.cross(q, vector)
+
+    return vector + w*t + np.cross(q, t)
+
+
+class PlatformMotion():
+    def __init__(self, axis = (1.0, 0.0, 0.0), lever = None, velocitySource = 'velocity',
+                 attitudeSource = 'attitude', rateSource = 'imu', maxAge = 0.5):
+        """
+        Velocity of the probe along its axis from the drone state forwarded
+        by the ROS client: the world frame (ENU) velocity, the attitude
+        quaternion and, with a lever arm, the body rates of the IMU.
+
+        Args:
+            axis (array): Direction the probe faces in the body frame (FLU).
+            lever (array): Probe position from the centre of gravity in the
+                body frame in m, None to ignore the rotation of the drone.
+            maxAge (float): Longest time in s samples wait for the state.
+        """
+        axis = np.asarray(axis, dtype = 'float')
+        self.axis = axis/np.linalg.norm(axis)
+        self.lever = None if lever is None else np.asarray(lever, dtype = 'float')
+        self.velocitySource = velocitySource
+        self.attitudeSource = attitudeSource
+        self.rateSource = rateSource
+        self.maxAge = maxAge
+
+    @property
+    def sources(self):
+        return [self.velocitySource, self.attitudeSource] + ([self.rateSource] if self.lever is not None else [])
+
+    def speed(self, times):
+        """Probe speed along its axis at each time, the state has to cover the times (see TelemetryWait)"""
+        velocity = TELEMETRY.interpolate(self.velocitySource, times)
+
+        #Linear interpolation of the quaternions, normalised again
+        attitude = TELEMETRY.interpolate(self.attitudeSource, times)
+        attitude /= np.linalg.norm(attitude, axis = -1, keepdims = True)
+
+        if self.lever is not None:
+            #Body rates are the last three IMU columns, the rotation adds rate x lever at the probe
+            rates = TELEMETRY.interpolate(self.rateSource, times)[:, 3:6]
+            velocity = velocity + rotate(attitude, np.cross(rates, self.lever))
+
+        return np.einsum('nk,nk->n', velocity, rotate(attitude, self.axis))
+
+
+@register_stage
+class PlatformCorrectionStage(Stage):
+    """
+    Removes the motion of the drone from the hotwire velocities of
+    'channels' (MCC channel numbers, all by default), so the output is
+    the wind speed blowing onto the probe. The drone state is interpolated onto the
+    sample times; see PlatformMotion for 'axis', 'lever' and 'maxAge'.
+    Samples are held until the state covering them has arrived and
+    dropped once it is more than maxAge behind, so the statistics
+    downstream only see corrected data.
+    """
+    name = 'platform_correction'
+
+    def setup(self, block):
+        selected = self.params.get('channels')
+        self.selected = slice(None) if selected is None else channel_rows(block.channels, selected)
+
+        self.motion = PlatformMotion(self.params.get('axis', (1.0, 0.0, 0.0)), self.params.get('lever'),
+                                     self.params.get('velocitySource', 'velocity'),
+                                     self.params.get('attitudeSource', 'attitude'),
+                                     self.params.get('rateSource', 'imu'), self.params.get('maxAge', 0.5))
+        self.wait = TelemetryWait(self.motion.sources, self.motion.maxAge)
+
+    def process(self, block):
+        ready, stale = self.wait.push(block)
+        if ready is None:
+            return None
+
+        times = ready.startTime + np.arange(ready.data.shape[-1])/ready.sampleFrequency
+
+        data = ready.data.copy()
+        data[self.selected] -= self.motion.speed(times)
+
+        return ready.replace(data = data)
+
+
+@register_stage
+class TurbulenceStatisticsStage(Stage):
+    """
+    Running mean, variance, skewness, flatness and turbulence intensity per
+    channel, plus a PDF if 'lowest' and 'highest' are given. Accumulates
+    until reset; with 'interval' set it also publishes and restarts every
+    interval seconds. Control actions: query, reset.
+    """
+    name = 'turbulence_statistics'
+
+    def setup(self, block):
+        numChannels = block.data.shape[0]
+
+        self.moments = StreamingMoments(numChannels)
+        self.pdf = None
+        if 'lowest' in self.params and 'highest' in self.params:
+            self.pdf = ChannelPDF(numChannels, self.params['lowest'], self.params['highest'],
+                                  self.params.get('bins', 100))
+
+        self.interval = self.params.get('interval')
+        self.intervalStart = block.startTime
+
+    def result(self):
+        frame = {'sampleFrequency': np.array(self.configuration[0]),
+                 'channels': np.array(self.configuration[1], dtype = 'float'),
+                 'intervalStart': np.array(self.intervalStart)}
+        frame.update(self.moments.statistics())
+
+        if self.pdf is not None:
+            frame['edges'] = self.pdf.edges()
+            frame['pdf'] = self.pdf.density()
+
+        return frame
+
+    def clear(self):
+        self.moments.reset()
+        if self.pdf is not None:
+            self.pdf.reset()
+
+    def process(self, block):
+        self.moments.update(block.data)
+        if self.pdf is not None:
+            self.pdf.add(block.data)
+
+        if self.interval is None:
+            return None
+
+        blockEnd = block.startTime + block.data.shape[-1]/block.sampleFrequency
+        if blockEnd - self.intervalStart < self.interval:
+            return None
+
+        frame = self.result()
+        self.clear()
+        self.intervalStart = blockEnd
+
+        return frame
+
+
+class StreamingAutocorrelation(StreamingWelch):
+    def __init__(self, sampleFrequency, numChannels, nperseg = 4096, **kwargs):
+        """
+        Autocorrelation of the fluctuations from the averaged power spectrum.
+
+        Segments are zero padded to twice their length before the FFT so the
+        inverse transform of the averaged |X|^2 is the linear, not circular,
+        correlation. Segment and averaging handling is StreamingWelch's.
+        """
+        kwargs.setdefault('noverlap', 0)
+        super(StreamingAutocorrelation, self).__init__(sampleFrequency, numChannels, nperseg = nperseg,
+                                                       window = 'boxcar', **kwargs)
+
+        self.lags = np.arange(self.nperseg)/sampleFrequency
+
+        #Number of products behind each lag, to remove the triangular bias
+        self.overlapCount = self.nperseg - np.arange(self.nperseg)
+
+    def estimate_shape(self):
+        return (self.numChannels, self.nperseg + 1)
+
+    def reset(self):
+        super(StreamingAutocorrelation, self).reset()
+        self.moments = StreamingMoments(self.numChannels)
+
+    def segment_estimates(self, segments):
+        #Remove the running mean rather than each segment's own, which would bias long lags
+        for segment in np.moveaxis(segments, 1, 0):
+            self.moments.update(segment)
+
+        segments = segments - self.moments.mean[:, None, None]
+        spectrum = fft.rfft(segments, n = 2*self.nperseg, axis = -1, workers = self.engine.workers)
+
+        return np.moveaxis(spectrum.real**2 + spectrum.imag**2, 1, 0)
+
+    def autocovariance(self):
+        return fft.irfft(self.estimate, axis = -1)[:, :self.nperseg]/self.overlapCount
+
+    def coefficient(self):
+        covariance = self.autocovariance()
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return covariance/covariance[:, :1]
+
+    def integral_time_scale(self, coefficient = None):
+        """Integral of the correlation coefficient up to its first zero crossing"""
+        if coefficient is None:
+            coefficient = self.coefficient()
+
+        crossed = coefficient <= 0
+        firstZero = np.where(crossed.any(axis = -1), crossed.argmax(axis = -1), self.nperseg)
+
+        #Trapezoidal integral stopping at the first zero crossing
+        dt = 1/self.sampleFrequency
+        area = np.concatenate((np.zeros((self.numChannels, 1)),
+                               np.cumsum(0.5*(coefficient[:, 1:] + coefficient[:, :-1])*dt, axis = -1)), axis = -1)
+
+        return area[np.arange(self.numChannels), np.minimum(firstZero, self.nperseg - 1)]
+
+
+@register_stage
+class AutocorrelationStage(Stage):
+    """
+    Autocorrelation coefficient up to 'lags' samples and integral time scale
+    per channel. With velocity input the integral length scale follows from
+    Taylor's hypothesis using the running mean.
+    """
+    name = 'autocorrelation'
+
+    def setup(self, block):
+        self.correlation = StreamingAutocorrelation(block.sampleFrequency, block.data.shape[0],
+                                                    nperseg = self.params.get('nperseg', 4096),
+                                                    average = self.params.get('average', AVERAGE_EXPONENTIAL),
+                                                    averages = self.params.get('averages', 16))
+        self.lagNumber = min(int(self.params.get('lags', 512)), self.correlation.nperseg)
+
+    def process(self, block):
+        if not self.correlation.update(block.data):
+            return None
+
+        coefficient = self.correlation.coefficient()
+        integralTime = self.correlation.integral_time_scale(coefficient)
+
+        return frame_for(block, lags = self.correlation.lags[:self.lagNumber].astype('float32'),
+                         coefficient = coefficient[:, :self.lagNumber].astype('float32'),
+                         integralTime = integralTime,
+                         integralLength = integralTime*np.abs(self.correlation.moments.mean))
+
+    def clear(self):
+        self.correlation.reset()
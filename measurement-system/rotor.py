@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+
+"""
+    Rotor stages - analysis synchronised to the shaft from a once-per-rev
+    tachometer pulse acquired on one of the DAQ channels. Importing this
+    module registers the stages with dsp_pipeline.
+"""
+
+import numpy as np
+
+from dsp_pipeline import Stage, register_stage, frame_for
+from spectral import StreamingWelch, AVERAGE_EXPONENTIAL
+from telemetry import TELEMETRY, TelemetryWait
+
+
+class TachoDetector():
+    def __init__(self, threshold = 2.5, holdoff = 0):
+        """
+        Finds the rising edges of a once-per-rev pulse train block by block.
+
+        Edge times are interpolated linearly between the samples either side
+        of the threshold, which gives the sub-sample accuracy the angular
+        resampling needs. Edges closer than holdoff samples to the previous
+        one are ignored as bounces.
+        """
+        self.threshold = threshold
+        self.holdoff = holdoff
+        self.reset()
+
+    def reset(self):
+        self.previous = None
+        self.lastEdge = -np.inf
+
+    def process(self, tacho, start):
+        """Returns the absolute fractional sample index of the edges in tacho, which starts at start"""
+        if self.previous is None:
+            self.previous = tacho[0]
+
+        values = np.concatenate(([self.previous], tacho))
+        self.previous = tacho[-1]
+
+        crossings = np.flatnonzero((values[:-1] < self.threshold) & (values[1:] >= self.threshold))
+        before = values[crossings]
+        after = values[crossings + 1]
+
+        #values[0] is the last sample of the previous block
+        edges = start - 1 + crossings + (self.threshold - before)/(after - before)
+
+        kept = []
+        for edge in edges:
+            if edge - self.lastEdge >= self.holdoff:
+                kept.append(edge)
+                self.lastEdge = edge
+
+        return np.array(kept)
+
+
+class RevolutionBuffer():
+    def __init__(self, numChannels, start, maxLength):
+        """
+        Samples since the last complete revolution, so revolutions spanning
+        several blocks can be cut out once their closing edge arrives.
+        Revolutions longer than maxLength samples are dropped.
+        """
+        self.data = np.zeros((numChannels, 0))
+        self.start = start
+        self.keepFrom = start
+        self.maxLength = int(maxLength)
+        self.lastEdge = None
+
+    def push(self, data, edges):
+        """
+        Adds a block and its edges, returns the start and end edges of the
+        revolutions that are now complete.
+        """
+        #Only drop what the previous revolutions needed now they have been resampled
+        self.data = np.concatenate((self.data[:, self.keepFrom - self.start:], data), axis = -1)
+        self.start = self.keepFrom
+        end = self.start + self.data.shape[-1]
+
+        if self.lastEdge is not None:
+            edges = np.concatenate(([self.lastEdge], edges))
+
+        if len(edges):
+            self.lastEdge = edges[-1]
+
+        #Keep from the sample before the last edge, or the last sample to interpolate the next edge
+        self.keepFrom = end - 1 if self.lastEdge is None else int(np.floor(self.lastEdge))
+        if self.keepFrom < end - self.maxLength:
+            self.keepFrom = end - 1
+            self.lastEdge = None
+
+        return edges[:-1], edges[1:]
+
+    def resample(self, starts, ends, positions):
+        """
+        Linearly interpolates the revolutions returned by the last push at
+        the fractions of a revolution in positions, as one (channels,
+        revolutions, positions) array.
+        """
+        samples = starts[:, None] + (ends - starts)[:, None]*positions[None, :] - self.start
+
+        index = np.floor(samples).astype(int)
+        fraction = samples - index
+
+        lower = self.data[:, index]
+        upper = self.data[:, index + 1]
+
+        return lower + fraction*(upper - lower)
+
+
+class EnsembleAverage():
+    def __init__(self, numChannels, binNumber):
+        """Running mean and variance per channel and angular bin over the revolutions"""
+        self.count = 0
+        self.mean = np.zeros((numChannels, binNumber))
+        self.M2 = np.zeros((numChannels, binNumber))
+        self.delta = np.zeros((numChannels, binNumber))
+
+    def reset(self):
+        self.count = 0
+        self.mean[:] = 0
+        self.M2[:] = 0
+
+    def add(self, revolutions):
+        """Merges a (channels, revolutions, bins) batch with the running totals"""
+        nB = revolutions.shape[1]
+        if nB == 0:
+            return
+
+        meanB = revolutions.mean(axis = 1)
+        M2B = ((revolutions - meanB[:, None, :])**2).sum(axis = 1)
+
+        nA = self.count
+        n = nA + nB
+
+        np.subtract(meanB, self.mean, out = self.delta)
+        self.M2 += M2B
+        self.M2 += self.delta**2*(nA*nB/n)
+        self.mean += self.delta*(nB/n)
+        self.count = n
+
+    def variance(self):
+        return self.M2/max(self.count - 1, 1)
+
+
+class AngleResampler():
+    def __init__(self, samplesPerRev):
+        """
+        Resamples a stream at constant steps of shaft angle, given the shaft
+        position in revolutions at every sample. The last sample of each
+        block is kept so angles falling between blocks are not lost.
+        """
+        self.samplesPerRev = int(samplesPerRev)
+        self.reset()
+
+    def reset(self):
+        self.previous = None
+
+    def process(self, data, phase):
+        if self.previous is None:
+            self.previous = data[:, :1]
+            self.previousPhase = phase[:1]
+            self.nextAngle = int(np.ceil(phase[0]*self.samplesPerRev))
+
+        data = np.concatenate((self.previous, data), axis = -1)
+        phase = np.concatenate((self.previousPhase, phase))
+
+        lastAngle = int(np.floor(phase[-1]*self.samplesPerRev))
+        angles = np.arange(self.nextAngle, lastAngle + 1)/self.samplesPerRev
+
+        positions = np.interp(angles, phase, np.arange(len(phase)))
+        index = np.minimum(np.floor(positions).astype(int), len(phase) - 2)
+        fraction = positions - index
+
+        resampled = data[:, index] + fraction*(data[:, index + 1] - data[:, index])
+
+        self.nextAngle = max(self.nextAngle, lastAngle + 1)
+        self.previous = data[:, -1:]
+        self.previousPhase = phase[-1:]
+
+        return resampled
+
+
+@register_stage
+class PhaseAverageStage(Stage):
+    """
+    Phase-locked ensemble average of every channel but the 'tacho' one.
+    Each revolution between two tacho edges is resampled onto 'bins'
+    angular positions and merged into a running mean and variance. With
+    'revolutions' set, the average is published every that many revolutions
+    without being reset. Control actions: query, reset.
+    """
+    name = 'phase_average'
+
+    def setup(self, block):
+        channels = list(block.channels)
+        self.tachoIndex = channels.index(self.params['tacho'])
+        self.others = [index for index in range(len(channels)) if index != self.tachoIndex]
+        self.channels = [channels[index] for index in self.others]
+
+        self.detector = TachoDetector(self.params.get('threshold', 2.5),
+                                      self.params.get('holdoff', 0.0)*block.sampleFrequency)
+        self.buffer = RevolutionBuffer(len(self.others), block.start,
+                                       self.params.get('maxPeriod', 1.0)*block.sampleFrequency)
+
+        binNumber = int(self.params.get('bins', 256))
+        self.positions = np.arange(binNumber)/binNumber
+        self.average = EnsembleAverage(len(self.others), binNumber)
+
+        self.publish = self.params.get('revolutions')
+        self.published = 0
+        self.period = np.nan
+
+    def result(self):
+        return {'sampleFrequency': np.array(self.configuration[0]),
+                'channels': np.array(self.channels, dtype = 'float'),
+                'angle': 2*np.pi*self.positions,
+                'mean': self.average.mean.copy(),
+                'std': np.sqrt(self.average.variance()),
+                'count': np.array(self.average.count, dtype = 'float'),
+                'rpm': np.array(60*self.configuration[0]/self.period)}
+
+    def clear(self):
+        self.average.reset()
+        self.published = 0
+
+    def process(self, block):
+        edges = self.detector.process(block.data[self.tachoIndex], block.start)
+        starts, ends = self.buffer.push(block.data[self.others], edges)
+
+        if len(starts) == 0:
+            return None
+
+        self.average.add(self.buffer.resample(starts, ends, self.positions))
+        self.period = np.mean(ends - starts)
+
+        if self.publish is None or self.average.count - self.published < self.publish:
+            return None
+
+        self.published = self.average.count
+
+        return self.result()
+
+
+@register_stage
+class OrderSpectrumStage(Stage):
+    """
+    Order spectrum of every channel but the tacho one, so rotor tones stay
+    in the same bin through throttle changes. Blocks are resampled to
+    'samplesPerRev' samples per shaft revolution and fed to a streaming
+    Welch estimate whose frequency axis is then in orders.
+
+    The shaft position comes from the edges of a 'tacho' channel or, by
+    default, from the motor rpm forwarded by the ROS client ('source'
+    telemetry, 'motor' column) times 'ratio' (e.g. 1/pole pairs for an
+    electrical rpm). Samples are held until the rpm covering them has
+    arrived and skipped once the rpm is more than 'maxAge' seconds behind.
+    """
+    name = 'order_spectrum'
+
+    def setup(self, block):
+        channels = list(block.channels)
+        self.tachoIndex = channels.index(self.params['tacho']) if 'tacho' in self.params else None
+        self.others = [index for index in range(len(channels)) if index != self.tachoIndex]
+        self.channels = np.array([channels[index] for index in self.others], dtype = 'float')
+
+        samplesPerRev = int(self.params.get('samplesPerRev', 64))
+        self.positions = np.arange(samplesPerRev)/samplesPerRev
+
+        if self.tachoIndex is not None:
+            self.detector = TachoDetector(self.params.get('threshold', 2.5),
+                                          self.params.get('holdoff', 0.0)*block.sampleFrequency)
+            self.buffer = RevolutionBuffer(len(self.others), block.start,
+                                           self.params.get('maxPeriod', 1.0)*block.sampleFrequency)
+        else:
+            self.resampler = AngleResampler(samplesPerRev)
+            self.phase = 0.0
+            self.wait = TelemetryWait([self.params.get('source', 'rpm')], self.params.get('maxAge', 0.5))
+
+        #Sample frequency in samples per revolution, so the frequencies are orders
+        self.welch = StreamingWelch(samplesPerRev, len(self.others),
+                                    nperseg = self.params.get('nperseg', 16*samplesPerRev),
+                                    noverlap = self.params.get('noverlap'),
+                                    window = self.params.get('window', 'hann'),
+                                    average = self.params.get('average', AVERAGE_EXPONENTIAL),
+                                    averages = self.params.get('averages', 16))
+
+    def angle_domain(self, block):
+        """Returns the block resampled in shaft angle and the mean shaft rpm, None without a speed"""
+        if self.tachoIndex is not None:
+            edges = self.detector.process(block.data[self.tachoIndex], block.start)
+            starts, ends = self.buffer.push(block.data[self.others], edges)
+            if len(starts) == 0:
+                return None, None
+
+            revolutions = self.buffer.resample(starts, ends, self.positions)
+
+            return revolutions.reshape(len(self.others), -1), 60*block.sampleFrequency/np.mean(ends - starts)
+
+        #Integrate the shaft position only over samples the rpm has arrived for, not from a held rpm
+        ready, stale = self.wait.push(block)
+        if stale is not None:
+            self.resampler.reset()
+            return None, None
+
+        if ready is None:
+            return None, None
+
+        times = ready.startTime + np.arange(ready.data.shape[-1])/ready.sampleFrequency
+        rpm = TELEMETRY.interpolate(self.wait.sources[0], times)
+
+        rpm = np.maximum(rpm[:, self.params.get('motor', 0)]*self.params.get('ratio', 1.0), 0)
+        phase = self.phase + np.cumsum(rpm)/(60*ready.sampleFrequency)
+        self.phase = phase[-1]
+
+        return self.resampler.process(ready.data[self.others], phase), np.mean(rpm)
+
+    def process(self, block):
+        data, rpm = self.angle_domain(block)
+        if data is None or not self.welch.update(data):
+            return None
+
+        return frame_for(block, channels = self.channels, order = self.welch.frequency,
+                         psd = self.welch.psd.copy(), rpm = np.array(rpm),
+                         segments = np.array(self.welch.segments, dtype = 'float'))
+
+
+class HarmonicTracker():
+    def __init__(self, fundamental, harmonics = 5, search = 0.1, smoothing = 0.5):
+        """
+        Follows a fundamental (the blade passing frequency) and its harmonics
+        from spectrum to spectrum.
+
+        Harmonic h is searched for within h*search fundamentals of its
+        expected position (never more than half a fundamental, so the
+        windows do not overlap). The highest bin is refined by parabolic
+        interpolation of the levels in dB, and the fundamental moves towards
+        the power weighted mean of the harmonics divided by their order.
+
+        Args:
+            fundamental (float): Starting fundamental, in the units of the
+                spectrum axis (Hz, or orders for an order spectrum).
+            harmonics (int): Number of harmonics, the fundamental included.
+            search (float): Search half width relative to the fundamental.
+            smoothing (float): Fraction of the new estimate taken each update.
+        """
+        self.initial = float(fundamental)
+        self.numbers = np.arange(1, int(harmonics) + 1)
+        self.search = search
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        self.fundamental = self.initial
+
+    def track(self, axis, spectrum):
+        """
+        Locates the harmonics in a (channels, frequencies) power spectrum.
+
+        Returns:
+            frequency, level: (channels, harmonics) arrays, level in dB. NaN
+                for harmonics that are off the spectrum.
+        """
+        step = axis[1] - axis[0]
+        binNumber = spectrum.shape[-1]
+
+        centres = self.fundamental*self.numbers
+        halfWidths = np.minimum(self.search*self.numbers, 0.5)*self.fundamental
+        reach = max(int(np.ceil(halfWidths[-1]/step)), 1)
+
+        #Candidate bins of every harmonic, the peak needs a bin either side for the parabola
+        bins = np.rint((centres - axis[0])/step).astype(int)[:, None] + np.arange(-reach, reach + 1)
+        valid = (np.abs(axis[0] + bins*step - centres[:, None]) <= halfWidths[:, None]) & \
+                (bins >= 1) & (bins <= binNumber - 2)
+        bins = np.clip(bins, 1, binNumber - 2)
+
+        with np.errstate(divide = 'ignore'):
+            levels = 10*np.log10(spectrum)
+
+        candidates = np.where(valid, levels[:, bins], -np.inf)
+        peaks = bins[np.arange(len(self.numbers)), np.argmax(candidates, axis = -1)]
+
+        below = np.take_along_axis(levels, peaks - 1, axis = -1)
+        peak = np.take_along_axis(levels, peaks, axis = -1)
+        above = np.take_along_axis(levels, peaks + 1, axis = -1)
+
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            curvature = below - 2*peak + above
+            delta = np.where(curvature < 0, 0.5*(below - above)/curvature, 0.0)
+        delta = np.clip(np.nan_to_num(delta), -0.5, 0.5)
+
+        frequency = axis[0] + (peaks + delta)*step
+        level = peak - 0.25*(below - above)*delta
+
+        missing = ~valid.any(axis = -1)
+        frequency[:, missing] = np.nan
+        level[:, missing] = np.nan
+
+        #Move the fundamental towards the power weighted estimate of all channels and harmonics
+        weights = np.where(np.isfinite(level), 10**(np.nan_to_num(level, nan = -np.inf)/10), 0.0)
+        if weights.sum() > 0:
+            estimate = np.sum(weights*np.nan_to_num(frequency)/self.numbers)/weights.sum()
+            self.fundamental += self.smoothing*(estimate - self.fundamental)
+
+        return frequency, level
+
+
+@register_stage
+class HarmonicPeaksStage(Stage):
+    """
+    Tracks the blade passing frequency 'bpf' and its harmonics in the
+    spectra of a psd or order_spectrum stage and outputs only a table of
+    peak frequency and level per harmonic and channel. 'bpf' is in the
+    units of the spectrum axis (Hz, or orders), see HarmonicTracker for
+    'harmonics', 'search' and 'smoothing'. Levels are in dB relative to
+    'reference' squared.
+    """
+    name = 'harmonic_peaks'
+
+    def setup(self, frame):
+        self.tracker = HarmonicTracker(self.params['bpf'], self.params.get('harmonics', 5),
+                                       self.params.get('search', 0.1), self.params.get('smoothing', 0.5))
+
+    def process(self, frame):
+        axis = frame['frequency'] if 'frequency' in frame else frame['order']
+        frequency, level = self.tracker.track(axis, np.atleast_2d(frame['psd']))
+
+        level -= 20*np.log10(self.params.get('reference', 1.0))
+
+        return frame_for(frame, harmonic = self.tracker.numbers.astype('float32'),
+                         frequency = frequency.astype('float32'), level = level.astype('float32'),
+                         bpf = np.array(self.tracker.fundamental))
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+
+"""
+    Shared-memory ring buffer used to pass DAQ samples between processes.
+
+    A single writer (the acquisition process) appends interleaved frames of
+    samples, one value per channel, and any number of readers attach to the
+    same block of memory by name and copy out the samples they need. The
+    header holds the scan configuration so that readers can follow channel or
+    sample rate changes without talking to the writer.
+"""
+
+from multiprocessing import shared_memory
+from time import sleep, time
+
+import numpy as np
+
+
+#Default ring settings
+RING_NAME = 'lab_drone_daq_ring'
+RING_SECONDS = 10.0 #Seconds of data held at the maximum sample rate
+MAX_CHANNELS = 8    #MCC 128 has 8 single ended inputs
+MAX_SAMPLE_FREQUENCY = 100000.0 #Hz, aggregate MCC 128 limit
+
+#Header layout - every slot is a float64
+HEADER_WRITE_COUNT = 0        #Total frames written since the ring was created
+HEADER_GENERATION = 1         #Incremented every time the scan is (re)configured
+HEADER_GENERATION_START = 2   #Write count at which the current generation started
+HEADER_START_TIME = 3         #Wall clock time of the first frame of the generation
+HEADER_NUM_CHANNELS = 4
+HEADER_SAMPLE_FREQUENCY = 5
+HEADER_OVERRUNS = 6           #Number of hardware/buffer overruns seen by the writer
+HEADER_CHANNELS = 7           #MAX_CHANNELS slots holding the channel numbers
+HEADER_CAPTURE_LENGTH = HEADER_CHANNELS + MAX_CHANNELS #Frames per triggered capture, 0 for a continuous scan
+HEADER_SIZE = HEADER_CAPTURE_LENGTH + 1
+
+
+class RingOverrunError(Exception):
+    """Raised when a reader asks for frames that have already been overwritten"""
+
+
+class SharedRing():
+    def __init__(self, name = RING_NAME, capacity = None, create = False, readOnly = False):
+        """
+        Creates or attaches to a ring buffer in shared memory.
+
+        Args:
+            name (str): Name of the shared memory block.
+            capacity (int): Number of frames held in the ring, only used
+                when creating. Defaults to RING_SECONDS at the maximum rate.
+            create (bool): Create the block rather than attaching to it.
+            readOnly (bool): Attach without write access to the numpy views.
+        """
+        self.name = name
+        self.owner = create
+
+        if create:
+            if capacity is None:
+                capacity = int(RING_SECONDS*MAX_SAMPLE_FREQUENCY)
+
+            size = 8*(HEADER_SIZE + capacity*MAX_CHANNELS)
+
+            #Remove a block left behind by a process that did not shut down properly
+            try:
+                stale = shared_memory.SharedMemory(name = name)
+                stale.close()
+                stale.unlink()
+            except FileNotFoundError:
+                pass
+
+            self.shm = shared_memory.SharedMemory(name = name, create = True, size = size)
+        else:
+            #Readers are forked from the server, so they share its resource tracker
+            self.shm = shared_memory.SharedMemory(name = name)
+
+            capacity = (self.shm.size//8 - HEADER_SIZE)//MAX_CHANNELS
+
+        self.capacity = capacity
+
+        self.header = np.ndarray((HEADER_SIZE,), dtype = 'float64', buffer = self.shm.buf)
+        self.frames = np.ndarray((capacity, MAX_CHANNELS), dtype = 'float64',
+                                 buffer = self.shm.buf, offset = 8*HEADER_SIZE)
+
+        if create:
+            self.header[:] = 0
+
+        if readOnly:
+            self.header.flags.writeable = False
+            self.frames.flags.writeable = False
+
+    #Header accessors
+    @property
+    def write_count(self):
+        return int(self.header[HEADER_WRITE_COUNT])
+
+    @property
+    def generation(self):
+        return int(self.header[HEADER_GENERATION])
+
+    @property
+    def generation_start(self):
+        return int(self.header[HEADER_GENERATION_START])
+
+    @property
+    def start_time(self):
+        return float(self.header[HEADER_START_TIME])
+
+    @property
+    def num_channels(self):
+        return int(self.header[HEADER_NUM_CHANNELS])
+
+    @property
+    def sample_frequency(self):
+        return float(self.header[HEADER_SAMPLE_FREQUENCY])
+
+    @property
+    def overruns(self):
+        return int(self.header[HEADER_OVERRUNS])
+
+    @property
+    def channels(self):
+        return [int(chan) for chan in self.header[HEADER_CHANNELS:HEADER_CHANNELS + self.num_channels]]
+
+    @property
+    def capture_length(self):
+        return int(self.header[HEADER_CAPTURE_LENGTH])
+
+    def configure(self, channels, sampleFrequency, startTime = None, captureLength = 0):
+        """
+        Writer side - starts a new generation with the given scan settings.
+        Each triggered capture is its own generation, starting at the trigger.
+        """
+        self.header[HEADER_CAPTURE_LENGTH] = captureLength
+        self.header[HEADER_NUM_CHANNELS] = len(channels)
+        self.header[HEADER_SAMPLE_FREQUENCY] = sampleFrequency
+        self.header[HEADER_CHANNELS:HEADER_CHANNELS + len(channels)] = channels
+        self.header[HEADER_GENERATION_START] = self.header[HEADER_WRITE_COUNT]
+        self.header[HEADER_START_TIME] = time() if startTime is None else startTime
+
+        #Bump the generation last so readers never see a half written configuration
+        self.header[HEADER_GENERATION] += 1
+
+    def count_overrun(self):
+        self.header[HEADER_OVERRUNS] += 1
+
+    def write(self, data):
+        """
+        Writer side - appends interleaved HAT data to the ring.
+
+        Args:
+            data (array): Flat interleaved samples as returned by
+                a_in_scan_read, or an array of shape (frames, channels).
+        """
+        numChannels = self.num_channels
+        data = np.asarray(data, dtype = 'float64').reshape(-1, numChannels)
+
+        count = self.write_count
+        frameNumber = len(data)
+
+        #Keep only the most recent capacity frames if a very large block arrives
+        if frameNumber > self.capacity:
+            data = data[-self.capacity:]
+            count += frameNumber - self.capacity
+            frameNumber = self.capacity
+
+        start = count % self.capacity
+        first = min(frameNumber, self.capacity - start)
+
+        self.frames[start:start + first, :numChannels] = data[:first]
+        self.frames[:frameNumber - first, :numChannels] = data[first:]
+
+        #Publish the new frames only after they are in place
+        self.header[HEADER_WRITE_COUNT] = count + frameNumber
+
+    def read(self, start, count, out = None):
+        """
+        Reader side - copies frames [start, start + count) from the ring.
+
+        Returns:
+            array: Data of shape (channels, count).
+
+        Raises:
+            RingOverrunError: The frames are no longer in the ring.
+        """
+        numChannels = self.num_channels
+
+        if out is None:
+            out = np.empty((numChannels, count), dtype = 'float64')
+
+        ringStart = start % self.capacity
+        first = min(count, self.capacity - ringStart)
+
+        out[:, :first] = self.frames[ringStart:ringStart + first, :numChannels].T
+        out[:, first:] = self.frames[:count - first, :numChannels].T
+
+        #The writer may have lapped us while copying
+        if self.write_count - start > self.capacity:
+            raise RingOverrunError('Frames %d-%d have been overwritten'%(start, start + count))
+
+        return out
+
+    def wait_for(self, count, timeout = 5.0, pollInterval = 0.001):
+        """Reader side - sleeps until at least count frames have been written"""
+        deadline = time() + timeout
+
+        while self.write_count < count:
+            if time() > deadline:
+                return False
+
+            sleep(pollInterval)
+
+        return True
+
+    def close(self):
+        #Numpy views have to be released before the memory can be closed
+        del self.header
+        del self.frames
+        self.shm.close()
+
+        if self.owner:
+            self.shm.unlink()
@@ -24,6 +24,19 @@ from socketserver import ThreadingTCPServer, StreamRequestHandler
 import io 
 import struct 
 
+#Imports for the separate acquisition process
+from shared_ring import SharedRing
+from acquisition_process import AcquisitionProcess, RingDAQHandler
+
+#Imports for the streaming DSP pipeline - importing the stage modules registers the stages
+from dsp_pipeline import SharedPipeline, PipelineRunner, PipelineCommandMixin
+import dsp_stages
+import spectral
+import acoustics
+import hotwire
+import rotor
+import events
+
 
 
 #DAQ Settings
@@ -44,6 +57,13 @@ OUTPUT_FILE = DATA_DIR / 'hotwire_test.txt'
 #Server settings
 PORT = 8000
 
+#Run the HAT reader in its own process and read from the shared ring
+USE_ACQUISITION_PROCESS = True
+
+#Hardware trigger - name of a TriggerModes member for repeated captures on the trigger input, None for continuous
+TRIGGER_MODE = None
+CAPTURE_LENGTH = SAMPLE_NUMBER #Samples per triggered capture
+
 
 #Class to handle DAQ i/o - call read_data to return an array of data
 class DAQHandler():
@@ -206,15 +226,19 @@ class DAQHandler():
 
 
 #Handles TCP server requests - once connected the server reads from the daq, waits for a handshake/command, and 
-class DAQRequestHandler(StreamRequestHandler):
-    def __init__(self, daq):
+class DAQRequestHandler(PipelineCommandMixin, StreamRequestHandler):
+    def __init__(self, daq, pipeline):
         # super(DAQRequestHandler, self).__init__()
         self.daq = daq
+        self.pipeline = pipeline
+
+        #Pipeline subscriptions of this client, dropped when it disconnects
+        self.subscriptionIDs = set()
 
 
     #Override to call function - calls init class and inputs the read queue 
     def __call__(self, request, client_address, server):
-        h = DAQRequestHandler(self.daq)
+        h = DAQRequestHandler(self.daq, self.pipeline)
         StreamRequestHandler.__init__(h, request, client_address, server)
 
 
@@ -229,9 +253,14 @@ class DAQRequestHandler(StreamRequestHandler):
         self.send_data(stream, np.array([self.daq.sampleFrequency, self.daq.sampleNumber]))
 
 
-        while True: 
-            #Read handshake/command
-            self.read_command()
+        #Read handshake/command until the client disconnects
+        try:
+            while self.read_command():
+                pass
+        except ConnectionError:
+            pass
+
+        print(f"[DAQ Server] Client disconnected: {self.client_address[0]}:{self.client_address[1]}")
 
     def send_data(self, stream, data):
         #Create numpy array from DAQ data
@@ -248,7 +277,12 @@ class DAQRequestHandler(StreamRequestHandler):
         self.wfile.flush()
 
     def read_command(self):
-        data_len = struct.unpack('<L', self.rfile.read(struct.calcsize('<L')))[0]
+        """Handles one command, returns False once the client has closed the connection"""
+        header = self.rfile.read(struct.calcsize('<L'))
+        if len(header) < struct.calcsize('<L'):
+            return False
+
+        data_len = struct.unpack('<L', header)[0]
         response = np.frombuffer(self.rfile.read(data_len), dtype = 'float')
 
         #Save data if the array reads 1
@@ -266,10 +300,21 @@ class DAQRequestHandler(StreamRequestHandler):
             channels = np.frombuffer(self.rfile.read(data_len), dtype = 'uint8')
 
             self.on_channel_command(channels)
+
+        #Subscribe/fetch/unsubscribe/control commands for the DSP pipeline
+        else:
+            self.read_pipeline_command(int(response[0]))
+
+        return True
         
 
     def on_stream_command(self):
-        timeArray, dataArray = self.daq.read_data() 
+        #No block between triggered captures - reply with the same placeholder as after an overrun
+        try:
+            timeArray, dataArray = self.daq.read_data() 
+        except TimeoutError as err:
+            print('[DAQ Server] No data to stream:', err)
+            timeArray, dataArray = np.array([1]), np.array([1])
 
         stream = io.BytesIO()
 
@@ -303,7 +348,19 @@ class DAQRequestHandler(StreamRequestHandler):
 
 def main():
     #Initialize data acquisition device 
-    daq = DAQHandler()
+    if USE_ACQUISITION_PROCESS:
+        #The ring is owned by the server process, the acquisition process only writes to it
+        ring = SharedRing(create = True)
+
+        acquisition = AcquisitionProcess(CHANNELS, SAMPLE_FREQUENCY, AnalogInputMode.SE,
+                                         AnalogInputRange.BIP_5V,
+                                         triggerMode = TRIGGER_MODE, captureLength = CAPTURE_LENGTH)
+        acquisition.start()
+
+        daq = RingDAQHandler(acquisition, SAMPLE_NUMBER, outputFile = OUTPUT_FILE)
+        daq.wait_for_generation(0)
+    else:
+        daq = DAQHandler()
 
     #Local host
     HOST = '0.0.0.0'
@@ -311,7 +368,11 @@ def main():
     #Create server
     print('Creating server %s:%s'%(HOST, PORT))
 
-    server = ThreadingTCPServer((HOST, PORT), DAQRequestHandler(daq), False)
+    #Shared DSP pipeline, fed in its own thread while there are subscribers
+    pipeline = SharedPipeline()
+    PipelineRunner(daq, pipeline).start()
+
+    server = ThreadingTCPServer((HOST, PORT), DAQRequestHandler(daq, pipeline), False)
     
     #Fix for when server shuts down inproperly - enables rebinding to the same address
     server.allow_reuse_address = True 
@@ -322,6 +383,8 @@ def main():
     try:
         server.serve_forever()
     except KeyboardInterrupt: daq.stop_hat()
+    finally:
+        if USE_ACQUISITION_PROCESS: ring.close()
 
 # @dataclass 
 # class DAQSettings()
@@ -0,0 +1,532 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+
+"""
+    Streaming spectral estimators and their pipeline stages. Importing this
+    module registers the stages with dsp_pipeline.
+"""
+
+import functools
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import signal, fft
+
+from dsp_pipeline import Stage, register_stage, frame_for
+
+
+#Averaging modes for StreamingWelch
+AVERAGE_EXPONENTIAL = 'exponential'
+AVERAGE_COUNT = 'count'
+
+#Threads used by each batched FFT - the fourth core belongs to the acquisition process
+FFT_WORKERS = 3
+
+#Largest ring of periodograms a count average may keep, bytes
+MAX_HISTORY_BYTES = 64*1024**2
+
+
+class SpectralPlan():
+    """Window, density scaling and frequency axis for one segment configuration"""
+    def __init__(self, nperseg, window, sampleFrequency):
+        self.nperseg = nperseg
+        self.window = signal.get_window(window, nperseg)
+
+        #Density scaling as in signal.welch, with the one-sided doubling folded in
+        self.scale = np.full(nperseg//2 + 1, 2.0/(sampleFrequency*np.sum(self.window**2)))
+        self.scale[0] /= 2
+        if nperseg % 2 == 0:
+            self.scale[-1] /= 2
+
+        self.frequency = np.fft.rfftfreq(nperseg, 1/sampleFrequency)
+
+        #Plans are shared between engines, so make sure nobody changes them
+        for array in (self.window, self.scale, self.frequency):
+            array.flags.writeable = False
+
+
+@functools.lru_cache(maxsize = 32)
+def spectral_plan(nperseg, window, sampleFrequency):
+    return SpectralPlan(nperseg, window, sampleFrequency)
+
+
+def window_key(window):
+    #Windows with parameters arrive from JSON as lists, the cache needs a tuple
+    return tuple(window) if isinstance(window, list) else window
+
+
+class SpectralEngine():
+    def __init__(self, sampleFrequency, nperseg = 256, window = 'hann', detrend = True,
+                 workers = FFT_WORKERS):
+        """
+        Batched real FFTs of windowed segments using a cached SpectralPlan.
+
+        All channels and all segments of a block are transformed in a
+        single rfft call spread over workers threads.
+        """
+        self.sampleFrequency = sampleFrequency
+        self.nperseg = int(nperseg)
+        self.detrend = detrend
+        self.workers = workers
+
+        self.plan = spectral_plan(self.nperseg, window_key(window), float(sampleFrequency))
+
+    @property
+    def frequency(self):
+        return self.plan.frequency
+
+    @property
+    def scale(self):
+        return self.plan.scale
+
+    def segments(self, data, noverlap = None):
+        """Views of the overlapping segments of data, shape (channels, segments, nperseg)"""
+        hop = self.nperseg - (self.nperseg//2 if noverlap is None else int(noverlap))
+
+        return sliding_window_view(data, self.nperseg, axis = -1)[..., ::hop, :]
+
+    def spectra(self, segments):
+        """Complex one-sided spectra of segments (..., nperseg)"""
+        if self.detrend:
+            segments = segments - segments.mean(axis = -1, keepdims = True)
+
+        return fft.rfft(segments*self.plan.window, axis = -1, workers = self.workers)
+
+    def periodograms(self, segments):
+        spectrum = self.spectra(segments)
+
+        return (spectrum.real**2 + spectrum.imag**2)*self.plan.scale
+
+    def welch(self, data, noverlap = None):
+        """Same result as signal.welch(data, fs, nperseg = nperseg) for a whole block"""
+        return self.frequency, self.periodograms(self.segments(np.atleast_2d(data), noverlap)).mean(axis = -2)
+
+
+class SegmentBuffer():
+    """
+    Cuts a continuous stream into overlapping segments. Samples that do not
+    complete a segment are kept for the next block.
+    """
+    def __init__(self, numChannels, nperseg, hop):
+        self.numChannels = numChannels
+        self.nperseg = nperseg
+        self.hop = hop
+        self.tail = np.zeros((numChannels, 0))
+
+        #Number of samples dropped off the front of the stream so far
+        self.consumed = 0
+
+    def push(self, data):
+        """Returns the segments completed by data, shape (channels, segments, nperseg)"""
+        buffer = np.concatenate((self.tail, np.atleast_2d(data)), axis = -1)
+
+        if buffer.shape[-1] < self.nperseg:
+            self.tail = buffer
+            return np.zeros((self.numChannels, 0, self.nperseg))
+
+        segmentNumber = (buffer.shape[-1] - self.nperseg)//self.hop + 1
+
+        #Keep what the next segment will need
+        self.tail = buffer[:, segmentNumber*self.hop:]
+        self.consumed += segmentNumber*self.hop
+
+        return sliding_window_view(buffer, self.nperseg, axis = -1)[:, ::self.hop][:, :segmentNumber]
+
+
+class StreamingWelch():
+    def __init__(self, sampleFrequency, numChannels, nperseg = 256, noverlap = None,
+                 window = 'hann', average = AVERAGE_EXPONENTIAL, averages = 16, detrend = True):
+        """
+        Welch PSD estimate updated block by block.
+
+        Samples that do not fill a whole segment are kept until the next
+        block, so segments straddling block edges are not lost, and each
+        block only costs the transforms of the segments it completes.
+
+        Args:
+            sampleFrequency (float): Sample frequency of the input in Hz.
+            numChannels (int): Number of channels in each block.
+            nperseg (int): Segment length.
+            noverlap (int): Overlap between segments, defaults to nperseg//2.
+            window (str): Window name passed to signal.get_window.
+            average (str): 'exponential' for an exponential average with a
+                time constant of averages segments, or 'count' for the mean
+                of the last averages segments.
+            averages (int): Number of segments in the average, for 'count'
+                limited by MAX_HISTORY_BYTES.
+            detrend (bool): Remove the mean of each segment.
+        """
+        self.sampleFrequency = sampleFrequency
+        self.numChannels = numChannels
+        self.nperseg = int(nperseg)
+        self.noverlap = self.nperseg//2 if noverlap is None else int(noverlap)
+        self.hop = self.nperseg - self.noverlap
+        self.average = average
+        self.averages = max(1, int(averages))
+        self.detrend = detrend
+
+        if self.hop <= 0:
+            raise ValueError('noverlap must be less than nperseg')
+
+        if average not in (AVERAGE_EXPONENTIAL, AVERAGE_COUNT):
+            raise ValueError('Unknown average %s'%average)
+
+        self.engine = SpectralEngine(sampleFrequency, self.nperseg, window, detrend)
+        self.frequency = self.engine.frequency
+
+        #averages comes from the clients, the count average keeps that many full estimates
+        if average == AVERAGE_COUNT:
+            historyBytes = self.averages*np.prod(self.estimate_shape())*np.dtype(self.estimate_dtype).itemsize
+            if historyBytes > MAX_HISTORY_BYTES:
+                raise ValueError('%d count averages need %.0f MB, more than the %.0f MB allowed'
+                                 %(self.averages, historyBytes/1024**2, MAX_HISTORY_BYTES/1024**2))
+
+        self.reset()
+
+    def reset(self):
+        self.buffer = SegmentBuffer(self.numChannels, self.nperseg, self.hop)
+        self.segments = 0
+        self.estimate = np.zeros(self.estimate_shape(), dtype = self.estimate_dtype)
+
+        #Ring of the last periodograms for the fixed count average
+        if self.average == AVERAGE_COUNT:
+            self.history = np.zeros((self.averages,) + self.estimate_shape(), dtype = self.estimate_dtype)
+            self.historySum = np.zeros(self.estimate_shape(), dtype = self.estimate_dtype)
+
+    #Shape and type of the averaged quantity, overridden by CrossSpectralMatrix
+    estimate_dtype = 'float64'
+
+    def estimate_shape(self):
+        return (self.numChannels, len(self.frequency))
+
+    @property
+    def psd(self):
+        return self.estimate
+
+    def update(self, data):
+        """
+        Adds a block of shape (channels, samples) to the estimate.
+
+        Returns:
+            bool: True if the estimate changed.
+        """
+        segments = self.buffer.push(data)
+        if segments.shape[1] == 0:
+            return False
+
+        self.accumulate(self.segment_estimates(segments))
+
+        return True
+
+    def segment_estimates(self, segments):
+        """Quantity averaged for each segment, with the segment axis first"""
+        return np.moveaxis(self.engine.periodograms(segments), 1, 0)
+
+    def accumulate(self, estimates):
+        """Averages per segment estimates, shape (segments,) + estimate_shape()"""
+        if self.average == AVERAGE_EXPONENTIAL:
+            #Plain mean until the average is full so the start is not biased towards zero
+            for estimate in estimates:
+                weight = 1.0/min(self.segments + 1, self.averages)
+                self.estimate += weight*(estimate - self.estimate)
+                self.segments += 1
+
+        else:
+            for estimate in estimates:
+                slot = self.segments % self.averages
+                self.historySum += estimate - self.history[slot]
+                self.history[slot] = estimate
+                self.segments += 1
+
+            self.estimate = self.historySum/min(self.segments, self.averages)
+
+        return len(estimates)
+
+
+class CrossSpectralMatrix(StreamingWelch):
+    """
+    Streaming auto and cross spectral densities of all channel pairs.
+
+    estimate[i, j] is the one-sided CSD conj(X_i)*X_j, the same convention
+    as signal.csd(x_i, x_j), computed from one batched FFT of every
+    channel and averaged like StreamingWelch.
+    """
+    estimate_dtype = 'complex128'
+
+    def estimate_shape(self):
+        return (self.numChannels, self.numChannels, len(self.frequency))
+
+    def segment_estimates(self, segments):
+        spectra = self.engine.spectra(segments)
+
+        return np.einsum('isf,jsf->sijf', spectra.conj(), spectra)*self.engine.scale
+
+    @property
+    def pairs(self):
+        return [(i, j) for i in range(self.numChannels) for j in range(i + 1, self.numChannels)]
+
+    def auto_spectra(self):
+        return np.einsum('iif->if', self.estimate).real
+
+    def coherence(self):
+        auto = self.auto_spectra()
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return np.abs(self.estimate)**2/(auto[:, None, :]*auto[None, :, :])
+
+    def transfer_function(self):
+        """H1 estimate from channel i to channel j, Gij/Gii"""
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return self.estimate/self.auto_spectra()[:, None, :]
+
+
+class ZoomSpectrum(StreamingWelch):
+    def __init__(self, sampleFrequency, numChannels, centre, span, nperseg = 256, **kwargs):
+        """
+        High resolution PSD of the band centre +/- span/2 only.
+
+        Each block is shifted down by the centre frequency (complex
+        demodulation), low-pass filtered and decimated to a rate just above
+        span, then averaged like StreamingWelch using two-sided FFTs of the
+        baseband. The resolution is that of a full band FFT sampleFrequency/
+        decimation times longer, for the cost of the filter and a short FFT.
+
+        Args:
+            centre (float): Centre frequency in Hz.
+            span (float): Width of the analysed band in Hz.
+            nperseg (int): Segment length at the decimated rate.
+        """
+        if not 0 < span < sampleFrequency:
+            raise ValueError('Zoom span must be between 0 and the sample frequency')
+
+        self.centre = float(centre)
+        self.span = float(span)
+        self.inputFrequency = float(sampleFrequency)
+
+        #Decimated rate keeps a margin above the span for the filter transition
+        self.decimation = max(1, int(sampleFrequency/(1.25*span)))
+        self.sos = signal.cheby1(8, 0.05, min(0.99, span/sampleFrequency), output = 'sos')
+
+        #Detrending would remove the component sitting exactly at the centre frequency
+        kwargs['detrend'] = False
+        super(ZoomSpectrum, self).__init__(sampleFrequency/self.decimation, numChannels,
+                                           nperseg = nperseg, **kwargs)
+
+        baseband = np.fft.fftshift(np.fft.fftfreq(self.nperseg, self.decimation/sampleFrequency))
+        self.band = np.abs(baseband) <= span/2
+        self.frequency = self.centre + baseband[self.band]
+
+        #Two-sided density scaling of the baseband spectrum
+        self.twoSidedScale = 1.0/(self.sampleFrequency*np.sum(self.engine.plan.window**2))
+
+    def reset(self):
+        super(ZoomSpectrum, self).reset()
+
+        self.zi = np.zeros((self.sos.shape[0], self.numChannels, 2), dtype = 'complex128')
+        self.phase = 0.0
+        self.offset = 0
+
+    def estimate_shape(self):
+        return (self.numChannels, self.nperseg)
+
+    def segment_estimates(self, segments):
+        spectrum = fft.fft(segments*self.engine.plan.window, axis = -1, workers = self.engine.workers)
+        periodograms = (spectrum.real**2 + spectrum.imag**2)*self.twoSidedScale
+
+        return np.moveaxis(np.fft.fftshift(periodograms, axes = -1), 1, 0)
+
+    def update(self, data):
+        data = np.atleast_2d(data)
+        sampleNumber = data.shape[-1]
+
+        #Keep the phase of the oscillator continuous across blocks
+        step = 2*np.pi*self.centre/self.inputFrequency
+        phase = self.phase + step*np.arange(sampleNumber)
+        self.phase = (self.phase + step*sampleNumber) % (2*np.pi)
+
+        baseband, self.zi = signal.sosfilt(self.sos, data*np.exp(-1j*phase), axis = -1, zi = self.zi)
+
+        offset = self.offset
+        self.offset = (offset - sampleNumber) % self.decimation
+
+        return super(ZoomSpectrum, self).update(baseband[:, offset::self.decimation])
+
+    @property
+    def psd(self):
+        #Two sided baseband density folded back to the one-sided convention of signal.welch
+        return 2*self.estimate.real[:, self.band]
+
+
+@register_stage
+class ZoomStage(Stage):
+    """Zoom PSD of a narrow band around a rotor tone"""
+    name = 'zoom'
+
+    def setup(self, block):
+        self.zoom = ZoomSpectrum(block.sampleFrequency, block.data.shape[0],
+                                 self.params['centre'], self.params['span'],
+                                 nperseg = self.params.get('nperseg', 256),
+                                 window = self.params.get('window', 'hann'),
+                                 average = self.params.get('average', AVERAGE_EXPONENTIAL),
+                                 averages = self.params.get('averages', 16))
+
+    def process(self, block):
+        if not self.zoom.update(block.data):
+            return None
+
+        return frame_for(block, frequency = self.zoom.frequency, psd = self.zoom.psd,
+                         segments = np.array(self.zoom.segments, dtype = 'float'))
+
+
+@register_stage
+class PSDStage(Stage):
+    """Streaming Welch PSD, emits an updated spectrum for every block that completes a segment"""
+    name = 'psd'
+
+    def setup(self, block):
+        self.welch = StreamingWelch(block.sampleFrequency, block.data.shape[0],
+                                    nperseg = self.params.get('nperseg', 256),
+                                    noverlap = self.params.get('noverlap'),
+                                    window = self.params.get('window', 'hann'),
+                                    average = self.params.get('average', AVERAGE_EXPONENTIAL),
+                                    averages = self.params.get('averages', 16))
+
+    def process(self, block):
+        if not self.welch.update(block.data):
+            return None
+
+        return frame_for(block, frequency = self.welch.frequency, psd = self.welch.psd.copy(),
+                         segments = np.array(self.welch.segments, dtype = 'float'))
+
+
+@register_stage
+class SpectrogramStage(Stage):
+    """
+    Successive STFT columns in dB. The last history columns are kept in a
+    ring so that a client joining an existing spectrogram gets them
+    straight away.
+    """
+    name = 'spectrogram'
+
+    def setup(self, block):
+        nperseg = int(self.params.get('nperseg', 256))
+        self.hop = int(self.params.get('hop', nperseg//2))
+        self.history = int(self.params.get('history', 200))
+        self.dtype = self.params.get('dtype', 'float16')
+        self.reference = float(self.params.get('reference', 1.0))
+
+        if self.dtype not in ('float16', 'float32'):
+            raise ValueError('Spectrogram dtype must be float16 or float32')
+
+        self.engine = SpectralEngine(block.sampleFrequency, nperseg, self.params.get('window', 'hann'))
+        self.buffer = SegmentBuffer(block.data.shape[0], nperseg, self.hop)
+
+        #Time of the centre of the first column
+        self.origin = block.startTime + 0.5*nperseg/block.sampleFrequency
+
+        self.columns = np.zeros((self.history, block.data.shape[0], len(self.engine.frequency)), dtype = self.dtype)
+        self.columnTimes = np.zeros(self.history)
+        self.columnCount = 0
+
+    def to_dB(self, periodograms):
+        return (10*np.log10(periodograms/self.reference**2 + 1e-30)).astype(self.dtype)
+
+    def process(self, block):
+        consumed = self.buffer.consumed
+        segments = self.buffer.push(block.data)
+
+        columnNumber = segments.shape[1]
+        if columnNumber == 0:
+            return None
+
+        columns = np.moveaxis(self.to_dB(self.engine.periodograms(segments)), 1, 0)
+        times = self.origin + (consumed + self.hop*np.arange(columnNumber))/block.sampleFrequency
+
+        #Write the new columns into the history ring
+        keep = min(columnNumber, self.history)
+        slots = (self.columnCount + columnNumber - keep + np.arange(keep)) % self.history
+        self.columns[slots] = columns[-keep:]
+        self.columnTimes[slots] = times[-keep:]
+        self.columnCount += columnNumber
+
+        return frame_for(block, frequency = self.engine.frequency.astype('float32'),
+                         columns = columns, columnTimes = times)
+
+    def snapshot(self):
+        """Most recent columns in time order, for a subscriber that just joined"""
+        if self.configuration is None or self.columnCount == 0:
+            return None
+
+        number = min(self.columnCount, self.history)
+        slots = (self.columnCount - number + np.arange(number)) % self.history
+
+        return {'sampleFrequency': np.array(self.configuration[0]),
+                'channels': np.array(self.configuration[1], dtype = 'float'),
+                'start': np.array(0.0), 'startTime': np.array(self.columnTimes[slots[0]]),
+                'frequency': self.engine.frequency.astype('float32'),
+                'columns': self.columns[slots], 'columnTimes': self.columnTimes[slots]}
+
+
+@register_stage
+class CrossSpectraStage(Stage):
+    """
+    Auto spectra plus cross spectra, coherence, phase and H1 transfer
+    function for each channel pair (i < j), sent in single precision.
+    """
+    name = 'cross_spectra'
+
+    def setup(self, block):
+        self.matrix = CrossSpectralMatrix(block.sampleFrequency, block.data.shape[0],
+                                          nperseg = self.params.get('nperseg', 256),
+                                          noverlap = self.params.get('noverlap'),
+                                          window = self.params.get('window', 'hann'),
+                                          average = self.params.get('average', AVERAGE_EXPONENTIAL),
+                                          averages = self.params.get('averages', 16))
+
+        self.pairs = self.matrix.pairs
+        self.first = [i for i, j in self.pairs]
+        self.second = [j for i, j in self.pairs]
+
+    def process(self, block):
+        if not self.matrix.update(block.data):
+            return None
+
+        cross = self.matrix.estimate[self.first, self.second]
+
+        return frame_for(block, frequency = self.matrix.frequency.astype('float32'),
+                         pairs = np.array(self.pairs, dtype = 'float'),
+                         auto = self.matrix.auto_spectra().astype('float32'),
+                         cross = cross.astype('complex64'),
+                         coherence = self.matrix.coherence()[self.first, self.second].astype('float32'),
+                         phase = np.angle(cross).astype('float32'),
+                         transfer = self.matrix.transfer_function()[self.first, self.second].astype('complex64'),
+                         segments = np.array(self.matrix.segments, dtype = 'float'))
+
+
+def benchmark(numChannels = 4, sampleNumber = 10000, sampleFrequency = 10000.0, nperseg = 256,
+              repeats = 200):
+    """Prints spectra/s for signal.welch and the batched engine on the same blocks"""
+    data = np.random.randn(numChannels, sampleNumber)
+    engine = SpectralEngine(sampleFrequency, nperseg)
+
+    results = {}
+    for name, function in (('signal.welch', lambda: signal.welch(data, fs = sampleFrequency, nperseg = nperseg)),
+                           ('SpectralEngine', lambda: engine.welch(data))):
+        function()
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            function()
+        elapsed = time.perf_counter() - start
+
+        #One spectrum is one channel of one block
+        results[name] = repeats*numChannels/elapsed
+        print('    %-16s %10.1f spectra/s'%(name, results[name]))
+
+    return results
+
+
+#Run the benchmark if file is ran directly
+if __name__ == "__main__":
+    print('[DSP] Spectrum benchmark')
+    benchmark()
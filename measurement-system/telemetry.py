@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#  -*- coding: utf-8 -*-
+
+"""
+    Low rate vehicle state forwarded by the ROS client from MAVROS (motor
+    rpm, IMU, velocity...). Each source is a time series that stages read
+    interpolated onto the sample times of their blocks.
+"""
+
+import threading
+from collections import deque
+from time import time
+
+import numpy as np
+
+
+#Samples kept per source
+TELEMETRY_HISTORY = 4000
+
+#Number of messages the clock offset is estimated over
+OFFSET_MESSAGES = 50
+
+
+class TelemetrySource():
+    def __init__(self, width):
+        self.width = width
+        self.times = np.zeros(0)
+        self.values = np.zeros((0, width))
+
+    def add(self, times, values):
+        times = np.atleast_1d(np.asarray(times, dtype = 'float'))
+        values = np.asarray(values, dtype = 'float').reshape(len(times), self.width)
+
+        #Drop anything older than what is already stored, interpolation needs increasing times
+        if len(self.times):
+            newer = times > self.times[-1]
+            times, values = times[newer], values[newer]
+
+        self.times = np.concatenate((self.times, times))[-TELEMETRY_HISTORY:]
+        self.values = np.concatenate((self.values, values))[-TELEMETRY_HISTORY:]
+
+    def interpolate(self, times):
+        """Linear interpolation onto times, holding the first and last values outside the stored range"""
+        if len(self.times) == 1:
+            return np.repeat(self.values, len(times), axis = 0)
+
+        index = np.clip(np.searchsorted(self.times, times), 1, len(self.times) - 1)
+        lowerTime = self.times[index - 1]
+        weight = np.clip((times - lowerTime)/(self.times[index] - lowerTime), 0, 1)[:, None]
+
+        return self.values[index - 1] + weight*(self.values[index] - self.values[index - 1])
+
+
+class TelemetryStore():
+    def __init__(self):
+        """
+        Telemetry received from the clients, by source name.
+
+        Clients send their own time stamps along with the time they sent the
+        message. The smallest difference to the arrival time over the last
+        messages (the one with the least network delay) is taken as the
+        offset between the clocks, so the vehicle and the Pi do not need to
+        be synchronised.
+        """
+        self.sources = {}
+        self.offsets = deque(maxlen = OFFSET_MESSAGES)
+        self.lock = threading.Lock()
+
+    @property
+    def offset(self):
+        return min(self.offsets) if self.offsets else 0.0
+
+    def add(self, name, times, values, sent = None):
+        with self.lock:
+            if sent is not None:
+                self.offsets.append(time() - sent)
+
+            values = np.asarray(values, dtype = 'float')
+            width = 1 if values.ndim < 2 else values.shape[-1]
+
+            if name not in self.sources or self.sources[name].width != width:
+                self.sources[name] = TelemetrySource(width)
+
+            source = self.sources[name]
+            source.add(np.asarray(times, dtype = 'float') + self.offset, values)
+
+            return len(source.times)
+
+    def interpolate(self, name, times):
+        """Values of a source at the given server times, shape (times, width), None if nothing was received"""
+        with self.lock:
+            source = self.sources.get(name)
+            if source is None or len(source.times) == 0:
+                return None
+
+            return source.interpolate(np.asarray(times, dtype = 'float'))
+
+    def latest(self, name):
+        """Time of the last sample of a source"""
+        with self.lock:
+            source = self.sources.get(name)
+            if source is None or len(source.times) == 0:
+                return None
+
+            return source.times[-1]
+
+
+#Shared by the request handlers and the pipeline stages
+TELEMETRY = TelemetryStore()
+
+
+class TelemetryWait():
+    def __init__(self, sources, maxAge = 0.5, multiple = 1, store = TELEMETRY):
+        """
+        Holds blocks back until the telemetry of every source covers their
+        samples. The ROS client sends its state after the samples it
+        describes were read, so interpolating as soon as a block arrives
+        would mostly hold the last value received.
+
+        Args:
+            sources (list): Names of the telemetry sources needed.
+            maxAge (float): Samples are given up on once they are this many
+                s newer than the telemetry.
+            multiple (int): Blocks are released in multiples of this many
+                samples.
+        """
+        self.sources = list(sources)
+        self.maxAge = maxAge
+        self.multiple = int(multiple)
+        self.store = store
+        self.pending = None
+
+    def clear(self):
+        self.pending = None
+
+    def push(self, block):
+        """
+        Adds a block after the held samples.
+
+        Returns:
+            (Block, Block): The held samples the telemetry now covers and
+            the samples given up on as stale, either of them None.
+        """
+        if self.pending is None:
+            self.pending = block
+        else:
+            self.pending = self.pending.replace(data = np.concatenate((self.pending.data, block.data), axis = -1))
+
+        pending = self.pending
+        sampleNumber = pending.data.shape[-1]
+        fs = pending.sampleFrequency
+
+        latest = [self.store.latest(source) for source in self.sources]
+        if None in latest or pending.startTime + (sampleNumber - 1)/fs - min(latest) > self.maxAge:
+            self.pending = None
+            return None, pending
+
+        covered = int(np.clip(np.floor((min(latest) - pending.startTime)*fs) + 1, 0, sampleNumber))
+        usable = covered//self.multiple*self.multiple
+        if usable == 0:
+            return None, None
+
+        if usable == sampleNumber:
+            self.pending = None
+        else:
+            self.pending = pending.replace(data = pending.data[:, usable:], start = pending.start + usable,
+                                           startTime = pending.startTime + usable/fs)
+
+        return pending.replace(data = pending.data[:, :usable]), None